@@ -0,0 +1,60 @@
+"""Per-message cost of the moderation detectors against their pre-optimization versions.
+
+Run from the repository root:  python benchmarks/bench_moderation.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "tests")]
+# Importing bot needs a Gemini key and reads its state files; keep both away from real ones
+os.environ.setdefault("GEMINI_KEY", "benchmark")
+_state_dir = tempfile.mkdtemp(prefix="bot-bench-")
+for name, filename in (("STATE_DB_FILE", "bot_state.db"), ("SCHEDULER_FILE", "scheduled_jobs.json"),
+                       ("SNAPSHOT_FILE", "state_snapshot.bin")):
+    os.environ.setdefault(name, os.path.join(_state_dir, filename))
+
+import logging
+logging.disable(logging.CRITICAL)
+
+import bot
+import legacy_moderation
+
+CHAT_LINES = []
+for corpus in ("chat_lines.txt", "spam_lines.txt"):
+    with open(os.path.join(ROOT, "tests", "corpus", corpus), encoding="utf-8") as f:
+        CHAT_LINES += f.read().splitlines()
+LONG_MESSAGE = (" ".join(CHAT_LINES) * 3)[:2000]
+
+DETECTORS = [
+    ("detect_profanity", legacy_moderation.detect_profanity, bot.detect_profanity),
+    ("detect_spam", legacy_moderation.detect_spam, bot.detect_spam),
+]
+
+
+def per_call_us(func, lines, rounds=5, budget_seconds=0.2):
+    """Best-of-rounds mean cost per call, each round calling func over lines for ~budget_seconds."""
+    best = float("inf")
+    for _ in range(rounds):
+        calls = 0
+        started = time.perf_counter()
+        while (elapsed := time.perf_counter() - started) < budget_seconds:
+            for line in lines:
+                func(line)
+            calls += len(lines)
+        best = min(best, elapsed / calls)
+    return best * 1e6
+
+
+def main():
+    print(f"{'detector':<20} {'input':<22} {'before':>12} {'after':>12} {'speedup':>8}")
+    for name, before, after in DETECTORS:
+        for label, lines in ((f"chat corpus ({len(CHAT_LINES)})", CHAT_LINES), ("2000-char message", [LONG_MESSAGE])):
+            old, new = per_call_us(before, lines), per_call_us(after, lines)
+            print(f"{name:<20} {label:<22} {old:>9.1f} us {new:>9.1f} us {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
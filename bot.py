@@ -13,7 +13,21 @@ from bing_image_downloader import downloader
 from datetime import datetime, timedelta, timezone
 import asyncio
 import re
-import requests
+import sys
+import time
+import hashlib
+import signal
+import struct
+import zlib
+import queue
+import sqlite3
+import threading
+import heapq
+import shutil
+import tempfile
+import random
+import unicodedata
+from collections import Counter, OrderedDict, deque
 from typing import Dict, List
 
 # Set up logger with console output
@@ -39,46 +53,1119 @@ bot.remove_command('help')
 GEMINI_API_KEY = os.getenv("GEMINI_KEY")
 gemini_client = genai.Client(api_key=GEMINI_API_KEY)
 
+# Cap on concurrent in-flight Gemini generations (keeps one busy guild from hogging every socket)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Static system prompts are sent as system_instruction, and registered as Gemini cached contents
+# when GEMINI_CONTEXT_CACHE is on, so they aren't re-tokenized and re-billed on every request.
+# Prompts built from user input (e.g. a tutorial for whatever software they named) never are.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+GEMINI_CONTEXT_CACHE_REFRESH_SECONDS = 300  # extend the TTL once a cache is this close to expiring
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = 600  # back off after a failed create (e.g. prompt below the cache minimum)
+
+class SystemPromptCache:
+    """Keeps one Gemini cached content per (model, registered system prompt) alive for the whole process.
+    
+    Only prompts passed to register() are cached, so the maps below never hold more than
+    models x registered prompts."""
+
+    def __init__(self, ttl_seconds, refresh_seconds, retry_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self.prompt_keys = {}  # registered system prompt -> sha256
+        self.entries = {}  # (model, prompt sha256) -> {"name": cache name, "expires": monotonic time}
+        self.retry_after = {}  # key -> monotonic time before which we don't try to create again
+        self.locks = {}
+        self.refreshing = set()
+
+    def register(self, *system_prompts):
+        for system_prompt in system_prompts:
+            self.prompt_keys[system_prompt] = hashlib.sha256(system_prompt.encode()).hexdigest()
+
+    async def get_name(self, model, system_prompt):
+        """Return a cached content name for this prompt, or None to fall back to system_instruction."""
+        prompt_key = self.prompt_keys.get(system_prompt)
+        if prompt_key is None:
+            return None
+        key = (model, prompt_key)
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry and now < entry["expires"]:
+            if entry["expires"] - now < self.refresh_seconds and key not in self.refreshing:
+                self.refreshing.add(key)
+                asyncio.create_task(self._refresh(key, entry))
+            return entry["name"]
+        if now < self.retry_after.get(key, 0):
+            return None
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            entry = self.entries.get(key)
+            if entry and time.monotonic() < entry["expires"]:
+                return entry["name"]
+            try:
+                cache = await gemini_client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        ttl=f"{self.ttl_seconds}s",
+                        display_name="editing-helper-system-prompt"
+                    )
+                )
+                self.entries[key] = {"name": cache.name, "expires": time.monotonic() + self.ttl_seconds}
+                logger.info(f"Registered cached system prompt for {model}: {cache.name}")
+                return cache.name
+            except Exception as e:
+                self.retry_after[key] = time.monotonic() + self.retry_seconds
+                logger.warning(f"Context caching unavailable for {model}, using system_instruction: {e}")
+                return None
+
+    async def _refresh(self, key, entry):
+        try:
+            await gemini_client.aio.caches.update(
+                name=entry["name"],
+                config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s")
+            )
+            entry["expires"] = time.monotonic() + self.ttl_seconds
+        except Exception as e:
+            logger.warning(f"Could not refresh cached system prompt {entry['name']}: {e}")
+        finally:
+            self.refreshing.discard(key)
+
+system_prompt_cache = SystemPromptCache(GEMINI_CONTEXT_CACHE_TTL_SECONDS, GEMINI_CONTEXT_CACHE_REFRESH_SECONDS, GEMINI_CONTEXT_CACHE_RETRY_SECONDS)
+
+# How the system prompt was sent -> {"calls", "prompt_tokens", "cached_tokens", "seconds", "first_token_seconds"};
+# compare "cached" against "instruction" (GEMINI_CONTEXT_CACHE=0) to see what caching saves
+system_prompt_stats = {}
+
+def record_prompt_stats(mode, response, elapsed, first_token=None):
+    stats = system_prompt_stats.setdefault(mode, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "seconds": 0.0, "first_token_seconds": 0.0})
+    usage = getattr(response, "usage_metadata", None)
+    stats["calls"] += 1
+    stats["seconds"] += elapsed
+    # Non-streamed calls only see the first token when the whole response lands
+    stats["first_token_seconds"] += first_token if first_token is not None else elapsed
+    if usage:
+        stats["prompt_tokens"] += usage.prompt_token_count or 0
+        stats["cached_tokens"] += usage.cached_content_token_count or 0
+
+# Model routing: each kind of work names a task, and the task maps to an ordered list of models
+# (primary first, then fallbacks). Override a route with e.g.
+# MODEL_ROUTE_UTILITY="gemini-2.5-flash-lite,gemini-2.5-flash"
+TASK_MODERATION = "moderation"  # image safety verdicts
+TASK_UTILITY = "utility"  # short one-shot answers (!define, !emoji, !fix, ...)
+TASK_CHAT = "chat"  # conversation and general commands
+TASK_LONG_FORM = "long_form"  # !ask, !story, !script and other long outputs
+TASK_VISION = "vision"  # chat about an attached image
+TASK_VIDEO = "video"
+DEFAULT_MODEL_ROUTES = {
+    TASK_MODERATION: "gemini-2.0-flash,gemini-2.5-flash",
+    TASK_UTILITY: "gemini-2.5-flash,gemini-2.0-flash",
+    TASK_CHAT: "gemini-2.5-flash,gemini-2.0-flash",
+    TASK_LONG_FORM: "gemini-2.5-flash,gemini-2.0-flash",
+    TASK_VISION: "gemini-2.5-flash,gemini-2.0-flash",
+    TASK_VIDEO: "gemini-2.5-flash",
+}
+MODEL_ROUTES = {
+    task: [model.strip() for model in os.getenv(f"MODEL_ROUTE_{task.upper()}", default).split(",") if model.strip()]
+    for task, default in DEFAULT_MODEL_ROUTES.items()
+}
+MODEL_LATENCY_SAMPLES = 500
+
+class ModelTelemetry:
+    """Recent latencies plus running call, error and token counts for one model."""
+    __slots__ = ("latencies", "calls", "errors", "prompt_tokens", "output_tokens")
+
+    def __init__(self):
+        self.latencies = deque(maxlen=MODEL_LATENCY_SAMPLES)
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def percentile(self, fraction):
+        ordered = sorted(self.latencies)
+        return ordered[int(fraction * (len(ordered) - 1))] if ordered else 0.0
+
+model_telemetry = {}  # model -> ModelTelemetry
+model_fallbacks = Counter()  # task -> times a fallback model had to answer
+
+def record_model_call(model, elapsed, response=None, failed=False):
+    telemetry = model_telemetry.get(model)
+    if telemetry is None:
+        telemetry = model_telemetry[model] = ModelTelemetry()
+    telemetry.calls += 1
+    if failed:
+        telemetry.errors += 1
+        return
+    telemetry.latencies.append(elapsed)
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        telemetry.prompt_tokens += usage.prompt_token_count or 0
+        telemetry.output_tokens += usage.candidates_token_count or 0
+
+def should_fall_back(error):
+    """Rate limits, server errors, unknown models and transport failures may succeed on another model;
+    other client errors (bad input) would fail the same way everywhere."""
+    code = getattr(error, "code", None)
+    return not isinstance(code, int) or code in (404, 429) or code >= 500
+
+def system_prompt_config(config, update):
+    return config.model_copy(update=update) if config else types.GenerateContentConfig(**update)
+
+async def resolve_system_prompt(model, config, system_instruction):
+    """Attach the system prompt to config, as a cached content name when one is available."""
+    if not system_instruction:
+        return "none", config
+    cache_name = await system_prompt_cache.get_name(model, system_instruction) if GEMINI_CONTEXT_CACHE else None
+    update = {"cached_content": cache_name} if cache_name else {"system_instruction": system_instruction}
+    return ("cached" if cache_name else "instruction"), system_prompt_config(config, update)
+
+# Single-flight: identical requests already in flight share one upstream call instead of starting their own
+inflight_generations = {}  # request fingerprint -> asyncio.Task resolving to the response
+inflight_streams = {}  # request fingerprint -> StreamBroadcast
+single_flight_stats = {"coalesced": 0, "coalesced_streams": 0}
+
+def request_fingerprint(task, contents, config, system_instruction):
+    """Digest of everything that shapes a generation; equal digests get the same answer."""
+    digest = hashlib.sha256()
+    for part in (task, system_instruction or "", config.model_dump_json(exclude_none=True) if config else ""):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    for item in contents:
+        if isinstance(item, str):
+            digest.update(item.encode())
+        elif isinstance(item, bytes):
+            digest.update(item)
+        else:
+            digest.update(item.model_dump_json(exclude_none=True).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+async def run_gemini_generate(task, contents, config, system_instruction):
+    models = MODEL_ROUTES[task]
+    for attempt, model in enumerate(models):
+        mode, model_config = await resolve_system_prompt(model, config, system_instruction)
+        async with gemini_semaphore:
+            started = time.perf_counter()
+            try:
+                response = await gemini_client.aio.models.generate_content(
+                    model=model,
+                    contents=contents,
+                    config=model_config
+                )
+            except Exception as e:
+                record_model_call(model, time.perf_counter() - started, failed=True)
+                if is_rate_limit_error(e):
+                    admission.throttled()
+                if attempt + 1 == len(models) or not should_fall_back(e):
+                    raise
+                model_fallbacks[task] += 1
+                logger.warning(f"{model} failed for {task} ({e}), falling back to {models[attempt + 1]}")
+                continue
+        admission.recovered()
+        elapsed = time.perf_counter() - started
+        record_model_call(model, elapsed, response)
+        record_prompt_stats(mode, response, elapsed, elapsed)
+        return response
+
+async def gemini_generate(task, contents, config=None, system_instruction=None):
+    """Run a Gemini generation for a routed task on the SDK's async client so the event loop is never blocked."""
+    key = request_fingerprint(task, contents, config, system_instruction)
+    upstream = inflight_generations.get(key)
+    if upstream is not None:
+        single_flight_stats["coalesced"] += 1
+    else:
+        # The upstream call runs as its own task, so a waiter being cancelled never cancels it for the others
+        upstream = lifecycle.spawn(run_gemini_generate(task, contents, config, system_instruction), "gemini")
+        inflight_generations[key] = upstream
+        upstream.add_done_callback(lambda _: inflight_generations.pop(key, None))
+    return await asyncio.shield(upstream)
+
+class StreamBroadcast:
+    """Text pieces of one upstream stream, replayable from the start by any number of readers."""
+
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def publish(self, piece=None, error=None, done=False):
+        if piece is not None:
+            self.pieces.append(piece)
+        self.error = error
+        self.done = done
+        # Wake current readers; later waits get a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def read(self):
+        index = 0
+        while True:
+            if index < len(self.pieces):
+                index += 1
+                yield self.pieces[index - 1]
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self.changed.wait()
+
+async def run_gemini_stream(broadcast, task, contents, config, system_instruction):
+    models = MODEL_ROUTES[task]
+    for attempt, model in enumerate(models):
+        started = time.perf_counter()
+        try:
+            mode, model_config = await resolve_system_prompt(model, config, system_instruction)
+            async with gemini_semaphore:
+                started = time.perf_counter()
+                first_token = None
+                last_chunk = None
+                stream = await gemini_client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=model_config
+                )
+                async for chunk in stream:
+                    last_chunk = chunk
+                    if chunk.text:
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                        broadcast.publish(chunk.text)
+        except Exception as e:
+            record_model_call(model, time.perf_counter() - started, failed=True)
+            if is_rate_limit_error(e):
+                admission.throttled()
+            # Once readers have seen text from this model, switching models would garble the answer
+            if broadcast.pieces or attempt + 1 == len(models) or not should_fall_back(e):
+                broadcast.publish(error=e, done=True)
+                return
+            model_fallbacks[task] += 1
+            logger.warning(f"{model} failed for {task} ({e}), falling back to {models[attempt + 1]}")
+            continue
+        # The last chunk carries the usage totals for the whole response
+        elapsed = time.perf_counter() - started
+        record_model_call(model, elapsed, last_chunk)
+        record_prompt_stats(mode, last_chunk, elapsed, first_token)
+        admission.recovered()
+        broadcast.publish(done=True)
+        return
+
+async def gemini_generate_stream(task, contents, config=None, system_instruction=None):
+    """Stream a Gemini generation for a routed task, yielding text as it arrives."""
+    key = request_fingerprint(task, contents, config, system_instruction)
+    broadcast = inflight_streams.get(key)
+    if broadcast is not None:
+        single_flight_stats["coalesced_streams"] += 1
+    else:
+        broadcast = StreamBroadcast()
+        broadcast.task = lifecycle.spawn(run_gemini_stream(broadcast, task, contents, config, system_instruction), "gemini")
+        inflight_streams[key] = broadcast
+        broadcast.task.add_done_callback(lambda _: inflight_streams.pop(key, None))
+    async for piece in broadcast.read():
+        yield piece
+
+# Admission control for AI work: token buckets per user, per guild and global, granted in priority order
+PRIORITY_MODERATION = 0
+PRIORITY_CHAT = 1
+PRIORITY_CREATIVE = 2
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "5"))
+ADMISSION_USER_PER_MINUTE = float(os.getenv("ADMISSION_USER_PER_MINUTE", "10"))
+ADMISSION_GUILD_BURST = int(os.getenv("ADMISSION_GUILD_BURST", "30"))
+ADMISSION_GUILD_PER_MINUTE = float(os.getenv("ADMISSION_GUILD_PER_MINUTE", "120"))
+ADMISSION_GLOBAL_BURST = int(os.getenv("ADMISSION_GLOBAL_BURST", "60"))
+ADMISSION_GLOBAL_PER_MINUTE = float(os.getenv("ADMISSION_GLOBAL_PER_MINUTE", "600"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))  # waiting chat/creative requests
+ADMISSION_MAX_WAIT_SECONDS = int(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+ADMISSION_MAX_USER_BUCKETS = 10000
+ADMISSION_BACKOFF_MAX_SECONDS = 60  # longest pause after repeated 429s from Gemini
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a whole token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class AdmissionRejected(commands.CommandError):
+    """A request that can't be admitted; the message is shown to the user."""
+
+class AdmissionWaiter:
+    __slots__ = ("priority", "seq", "buckets", "future")
+
+    def __init__(self, priority, seq, buckets, future):
+        self.priority = priority
+        self.seq = seq
+        self.buckets = buckets
+        self.future = future
+
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+class AdmissionController:
+    """Grants AI requests once every bucket they draw from has a token; queued requests are served
+    strictly by priority class for the global bucket, and paused entirely while Gemini returns 429."""
+
+    def __init__(self):
+        self.user_buckets = OrderedDict()  # user_id -> TokenBucket, LRU-capped
+        self.guild_buckets = {}
+        self.global_bucket = TokenBucket(ADMISSION_GLOBAL_BURST, ADMISSION_GLOBAL_PER_MINUTE)
+        self.waiters = []
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.paused_until = 0.0
+        self.backoff = 0.0
+        self.stats = Counter()
+
+    def buckets_for(self, user_id, guild_id):
+        buckets = []
+        if user_id is not None:
+            bucket = self.user_buckets.get(user_id)
+            if bucket is None:
+                bucket = self.user_buckets[user_id] = TokenBucket(ADMISSION_USER_BURST, ADMISSION_USER_PER_MINUTE)
+                if len(self.user_buckets) > ADMISSION_MAX_USER_BUCKETS:
+                    self.user_buckets.popitem(last=False)
+            self.user_buckets.move_to_end(user_id)
+            buckets.append(bucket)
+        if guild_id is not None:
+            bucket = self.guild_buckets.get(guild_id)
+            if bucket is None:
+                bucket = self.guild_buckets[guild_id] = TokenBucket(ADMISSION_GUILD_BURST, ADMISSION_GUILD_PER_MINUTE)
+            buckets.append(bucket)
+        buckets.append(self.global_bucket)
+        return buckets
+
+    def queue_length(self):
+        return sum(1 for waiter in self.waiters if waiter.priority != PRIORITY_MODERATION)
+
+    @staticmethod
+    def held_by_own_buckets(waiter, now):
+        """True while a waiter is only waiting on its user/guild bucket, which holds nobody else up."""
+        return any(bucket.wait_time(now) for bucket in waiter.buckets[:-1])
+
+    def position(self, waiter):
+        now = time.monotonic()
+        return 1 + sum(
+            1 for other in self.waiters
+            if other.sort_key() < waiter.sort_key() and not self.held_by_own_buckets(other, now)
+        )
+
+    async def acquire(self, user_id, guild_id, priority, on_queued=None):
+        """Wait for admission. Moderation is never rejected; other classes raise AdmissionRejected
+        when the user is far over their rate, the queue is full, or the wait runs past the deadline."""
+        buckets = self.buckets_for(user_id, guild_id)
+        now = time.monotonic()
+        own_wait = max((bucket.wait_time(now) for bucket in buckets[:-1]), default=0.0)
+        # Held up by others: the 429 pause, the global bucket, or a waiter of the same or a higher
+        # class that's contending for the global bucket (not just sitting out its own rate limit)
+        contended = (
+            now < self.paused_until
+            or self.global_bucket.wait_time(now) > 0
+            or any(
+                other.priority <= priority and not other.future.done() and not self.held_by_own_buckets(other, now)
+                for other in self.waiters
+            )
+        )
+        if not own_wait and not contended:
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.stats["admitted"] += 1
+            return
+        
+        deadline = None
+        if priority != PRIORITY_MODERATION:
+            if own_wait > ADMISSION_MAX_WAIT_SECONDS:
+                self.stats["rejected"] += 1
+                raise AdmissionRejected(f"⏳ You're sending requests too fast - try again in {int(own_wait) + 1}s.")
+            if self.queue_length() >= ADMISSION_MAX_QUEUE:
+                self.stats["rejected"] += 1
+                raise AdmissionRejected("🚦 I'm handling a lot of requests right now - please try again in a minute.")
+            deadline = ADMISSION_MAX_WAIT_SECONDS
+        
+        self.seq += 1
+        waiter = AdmissionWaiter(priority, self.seq, buckets, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        self.stats["queued"] += 1
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        self.wakeup.set()
+        # Waiting out your own rate limit isn't a queue; only report a position when others are ahead
+        if on_queued and contended:
+            await on_queued(self.position(waiter))
+        try:
+            await asyncio.wait_for(waiter.future, deadline)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            raise AdmissionRejected("🚦 Still too busy to get to your request - please try again in a minute.")
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        self.stats["admitted"] += 1
+
+    async def dispatch(self):
+        while self.waiters:
+            now = time.monotonic()
+            delay = self.paused_until - now
+            if delay <= 0:
+                delay = None
+                for waiter in sorted(self.waiters, key=AdmissionWaiter.sort_key):
+                    if waiter.future.done():
+                        continue
+                    waits = [bucket.wait_time(now) for bucket in waiter.buckets]
+                    wait = max(waits)
+                    if not wait:
+                        for bucket in waiter.buckets:
+                            bucket.tokens -= 1
+                        waiter.future.set_result(None)
+                        self.waiters.remove(waiter)
+                        continue
+                    delay = wait if delay is None else min(delay, wait)
+                    # Waiting on its own user/guild bucket doesn't hold others up; waiting only on the
+                    # global bucket does, so lower classes never overtake higher ones
+                    if waits[-1] and not any(waits[:-1]):
+                        break
+            if not self.waiters:
+                break
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def throttled(self):
+        """Gemini returned 429: pause all admissions with exponential backoff and drain the global bucket."""
+        self.backoff = min(max(self.backoff * 2, 2.0), ADMISSION_BACKOFF_MAX_SECONDS)
+        self.paused_until = time.monotonic() + self.backoff
+        self.global_bucket.tokens = 0.0
+        self.stats["throttled"] += 1
+        logger.warning(f"Gemini rate limited us, pausing AI requests for {self.backoff:.0f}s")
+
+    def recovered(self):
+        self.backoff = 0.0
+
+admission = AdmissionController()
+
+def is_rate_limit_error(error):
+    return getattr(error, "code", None) == 429
+
+async def admit_message(message, priority):
+    """Admission for message-driven AI work; replies with the reason and returns False if rejected."""
+    try:
+        await admission.acquire(
+            message.author.id,
+            message.guild.id if message.guild else None,
+            priority,
+            on_queued=lambda position: message.reply(f"⏳ Lots of requests right now - you're #{position} in the queue.")
+        )
+    except AdmissionRejected as e:
+        await message.reply(str(e))
+        return False
+    return True
+
+# Conversation history limits: LRU cap on users, idle expiry, and a per-user size budget
+# (characters, roughly 4 per token) instead of a fixed turn count
+CONVERSATION_MAX_USERS = int(os.getenv("CONVERSATION_MAX_USERS", "5000"))
+CONVERSATION_IDLE_TTL_SECONDS = int(os.getenv("CONVERSATION_IDLE_TTL_SECONDS", str(6 * 3600)))
+CONVERSATION_MAX_CHARS_PER_USER = int(os.getenv("CONVERSATION_MAX_CHARS_PER_USER", "12000"))
+
+ROLE_USER = sys.intern("user")
+ROLE_MODEL = sys.intern("model")
+
+class ConversationTurn:
+    """One message in a user's history."""
+    __slots__ = ("role", "text")
+
+    def __init__(self, role, text):
+        self.role = sys.intern(role)
+        self.text = text
+
+class UserConversation:
+    """A user's turns, oldest first, plus bookkeeping for budgets and idle expiry."""
+    __slots__ = ("turns", "chars", "last_active")
+
+    def __init__(self):
+        self.turns = deque()
+        self.chars = 0
+        self.last_active = time.monotonic()
+
+class ConversationStore:
+    """Per-user chat history with an LRU user cap, idle TTL, and per-user character budget."""
+
+    def __init__(self, max_users, idle_ttl_seconds, max_chars_per_user):
+        self.max_users = max_users
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_chars_per_user = max_chars_per_user
+        self.users = OrderedDict()  # user_id -> UserConversation, least recently active first
+        self.evicted_users = 0
+        self.restored = None  # RestoredConversations from a warm-restart snapshot, if any
+
+    def lookup(self, user_id):
+        conversation = self.users.get(user_id)
+        if conversation is None and self.restored is not None:
+            conversation = self.restored.pop(user_id, self.idle_ttl_seconds)
+            if conversation is not None:
+                self.users[user_id] = conversation
+        return conversation
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def get(self, user_id):
+        """Return the user's turns (oldest first), or an empty list if none / expired."""
+        conversation = self.lookup(user_id)
+        if conversation is None:
+            return []
+        if time.monotonic() - conversation.last_active > self.idle_ttl_seconds:
+            del self.users[user_id]
+            self.evicted_users += 1
+            return []
+        return list(conversation.turns)
+
+    def append(self, user_id, role, text):
+        """Add a turn, dropping the user's oldest turns once over the character budget."""
+        now = time.monotonic()
+        conversation = self.lookup(user_id)
+        if conversation is None:
+            conversation = self.users[user_id] = UserConversation()
+        else:
+            self.users.move_to_end(user_id)
+        conversation.turns.append(ConversationTurn(role, text))
+        conversation.chars += len(text)
+        conversation.last_active = now
+        # Always keep the newest turn, even if it alone is over budget
+        while conversation.chars > self.max_chars_per_user and len(conversation.turns) > 1:
+            conversation.chars -= len(conversation.turns.popleft().text)
+        self.evict(now)
+
+    def clear(self, user_id):
+        self.users.pop(user_id, None)
+        if self.restored is not None:
+            # Also covers a clear that arrives before the snapshot has been indexed
+            self.restored.discard(user_id)
+
+    def evict(self, now=None):
+        """Drop idle users and enforce the user cap; cheap because users are kept in activity order."""
+        now = now or time.monotonic()
+        while self.users:
+            user_id, conversation = next(iter(self.users.items()))
+            if len(self.users) <= self.max_users and now - conversation.last_active <= self.idle_ttl_seconds:
+                break
+            del self.users[user_id]
+            self.evicted_users += 1
+
+    def memory_footprint(self):
+        """Approximate bytes held by the store (containers, turn records and text)."""
+        total = sys.getsizeof(self.users)
+        for conversation in self.users.values():
+            total += sys.getsizeof(conversation) + sys.getsizeof(conversation.turns)
+            for turn in conversation.turns:
+                total += sys.getsizeof(turn) + sys.getsizeof(turn.text)
+        return total
+
 # Store conversation history per user
-conversation_history = {}
+conversation_history = ConversationStore(CONVERSATION_MAX_USERS, CONVERSATION_IDLE_TTL_SECONDS, CONVERSATION_MAX_CHARS_PER_USER)
 
 # Track user states for multi-step conversations
 user_states = {}
 
-# Track user warnings for moderation (user_id: {"warnings": count, "last_spam_time": timestamp})
-user_warnings = {}
+import json
+
+# Warm restarts: conversation history and pending tutorial states are dumped to a compact binary
+# snapshot on SIGTERM/shutdown and every few minutes, and read back after a redeploy. (Warnings and
+# other durable state are already in the SQLite store.)
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "state_snapshot.bin")
+SNAPSHOT_INTERVAL_MINUTES = int(os.getenv("SNAPSHOT_INTERVAL_MINUTES", "5"))
+# Layout: header (magic, format version, section count), a table of (name, compressed length),
+# then each section zlib-compressed. Bump the version whenever a section's encoding changes;
+# snapshots from other versions are ignored rather than misread.
+SNAPSHOT_MAGIC = b"EHSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<6sHI")
+SNAPSHOT_SECTION = struct.Struct("<16sQ")
+# Conversation section: one record per user - (user_id, last active epoch, payload length) + JSON turns
+SNAPSHOT_USER_RECORD = struct.Struct("<QdI")
+SNAPSHOT_ROLES = {ROLE_USER: 0, ROLE_MODEL: 1}
+SNAPSHOT_ROLE_NAMES = (ROLE_USER, ROLE_MODEL)
+
+def encode_snapshot(sections):
+    """sections: {name: raw bytes}. Returns the snapshot file bytes (compression happens here)."""
+    compressed = [(name.encode(), zlib.compress(data, 6)) for name, data in sections.items()]
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(compressed))]
+    parts += [SNAPSHOT_SECTION.pack(name, len(data)) for name, data in compressed]
+    parts += [data for _, data in compressed]
+    return b"".join(parts)
+
+def encode_conversations(users):
+    """users: [(user_id, last active epoch, [(role, text), ...] or an already encoded payload)]
+    -> conversation section bytes."""
+    records = []
+    for user_id, last_active, turns in users:
+        if isinstance(turns, memoryview):
+            payload = turns
+        else:
+            payload = json.dumps([[SNAPSHOT_ROLES[role], text] for role, text in turns], separators=(",", ":")).encode()
+        records.append(SNAPSHOT_USER_RECORD.pack(user_id, last_active, len(payload)))
+        records.append(payload)
+    return b"".join(records)
+
+class SnapshotReader:
+    """Reads one snapshot file. Opening parses only the header; sections are decompressed on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sections = {}  # name -> (offset, compressed length)
+        with open(path, 'rb') as f:
+            magic, version, count = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(f"unsupported snapshot format {magic!r} v{version}")
+            offset = SNAPSHOT_HEADER.size + count * SNAPSHOT_SECTION.size
+            for _ in range(count):
+                name, length = SNAPSHOT_SECTION.unpack(f.read(SNAPSHOT_SECTION.size))
+                self.sections[name.rstrip(b"\0").decode()] = (offset, length)
+                offset += length
+
+    def read(self, name):
+        if name not in self.sections:
+            return b""
+        offset, length = self.sections[name]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+class RestoredConversations:
+    """Conversations from the last snapshot, handed to the ConversationStore one user at a time.
+    
+    The section is indexed in a background thread after startup, never on the event loop: a user
+    looked up before that finishes simply starts fresh. Each user's turns are only decoded when
+    that user next talks to the bot."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.index = None  # user_id -> (last active epoch, payload start, payload end)
+        self.data = b""
+        self.discarded = set()  # users whose snapshot history must not come back (cleared or started fresh)
+        self.lock = threading.Lock()
+        self.restored = 0
+        self.load_seconds = None
+
+    def load(self):
+        """Index the conversation section (blocking; run in a thread)."""
+        with self.lock:
+            if self.index is not None:
+                return
+            started = time.perf_counter()
+            index = {}
+            try:
+                data = self.reader.read("conversations")
+                position = 0
+                while position < len(data):
+                    user_id, last_active, length = SNAPSHOT_USER_RECORD.unpack_from(data, position)
+                    position += SNAPSHOT_USER_RECORD.size
+                    index[user_id] = (last_active, position, position + length)
+                    position += length
+            except Exception as e:
+                logger.error(f"Could not index conversation snapshot: {e}")
+                data, index = b"", {}
+            self.data = data
+            self.index = index
+            self.load_seconds = time.perf_counter() - started
+            logger.info(f"Indexed {len(index)} snapshot conversations in {self.load_seconds * 1000:.0f}ms")
+
+    def pending(self):
+        return len(self.index) if self.index is not None else None
+
+    def discard(self, user_id):
+        self.discarded.add(user_id)
+        if self.index is not None:
+            self.index.pop(user_id, None)
+
+    def pop(self, user_id, idle_ttl_seconds):
+        """The user's restored conversation (a UserConversation), or None."""
+        if self.index is None:
+            self.discarded.add(user_id)
+            return None
+        if user_id in self.discarded:
+            self.index.pop(user_id, None)
+            return None
+        entry = self.index.pop(user_id, None)
+        if entry is None:
+            return None
+        last_active, start, end = entry
+        payload = self.data[start:end]
+        if not self.index:
+            self.data = b""  # everyone restored or expired; release the buffer
+        idle = time.time() - last_active
+        if idle > idle_ttl_seconds:
+            return None
+        conversation = UserConversation()
+        for role, text in json.loads(payload):
+            conversation.turns.append(ConversationTurn(SNAPSHOT_ROLE_NAMES[role], text))
+            conversation.chars += len(text)
+        conversation.last_active = time.monotonic() - idle
+        self.restored += 1
+        return conversation
+
+def open_snapshot(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return SnapshotReader(path)
+    except Exception as e:
+        logger.warning(f"Ignoring state snapshot {path}: {e}")
+        return None
+
+def capture_snapshot():
+    """Copy the state to snapshot on the event loop: (role, text) pairs for live users, and the
+    still-encoded payloads of users carried over from the previous snapshot. Encoding happens in
+    write_snapshot."""
+    now_wall, now_mono = time.time(), time.monotonic()
+    users = [
+        (user_id, now_wall - (now_mono - conversation.last_active), [(turn.role, turn.text) for turn in conversation.turns])
+        for user_id, conversation in conversation_history.users.items()
+    ]
+    # Users not seen since the last restart are carried over byte for byte, unless they have gone
+    # idle past the TTL, and only as many of the most recent as the store itself would hold
+    restored = conversation_history.restored
+    if restored is not None and restored.index:
+        horizon = now_wall - conversation_history.idle_ttl_seconds
+        carried = [
+            (user_id, last_active, start, end)
+            for user_id, (last_active, start, end) in restored.index.items()
+            if last_active >= horizon and user_id not in conversation_history.users and user_id not in restored.discarded
+        ]
+        room = max(conversation_history.max_users - len(users), 0)
+        if len(carried) > room:
+            carried = heapq.nlargest(room, carried, key=lambda entry: entry[1])
+        data = memoryview(restored.data)
+        users += [(user_id, last_active, data[start:end]) for user_id, last_active, start, end in carried]
+    states = {str(user_id): state for user_id, state in user_states.items()}
+    return users, states
+
+def write_snapshot(path, users, states):
+    """Encode, compress and atomically write a snapshot (blocking; run in a thread)."""
+    data = encode_snapshot({
+        "conversations": encode_conversations(users),
+        "user_states": json.dumps(states).encode(),
+    })
+    with open(path + ".tmp", 'wb') as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    return len(data)
+
+async def save_snapshot():
+    if not SNAPSHOT_FILE:
+        return
+    started = time.perf_counter()
+    try:
+        restored = conversation_history.restored
+        if restored is not None and restored.index is None:
+            # Saving before the startup index finished (e.g. a quick redeploy): build it off the loop first
+            await asyncio.to_thread(restored.load)
+        users, states = capture_snapshot()
+        size = await asyncio.to_thread(write_snapshot, SNAPSHOT_FILE, users, states)
+        logger.info(f"Saved state snapshot: {len(users)} conversations, {size // 1024} KB in {(time.perf_counter() - started) * 1000:.0f}ms")
+    except Exception as e:
+        logger.error(f"Error saving state snapshot: {e}")
 
-# Server security tracking
-guild_join_history = {}  # guild_id: [{"user_id": id, "timestamp": time}, ...]
-guild_security_settings = {}  # guild_id: {"min_account_age_days": 7, "raid_alert_threshold": 5}
+@tasks.loop(minutes=SNAPSHOT_INTERVAL_MINUTES)
+async def save_state_snapshot():
+    """Periodic snapshot, so even a hard kill loses at most a few minutes of context."""
+    await save_snapshot()
+
+state_snapshot = open_snapshot(SNAPSHOT_FILE)
+if state_snapshot is not None:
+    conversation_history.restored = RestoredConversations(state_snapshot)
+    # Tutorial states are few and small, so they come back immediately
+    try:
+        user_states.update({int(user_id): state for user_id, state in json.loads(state_snapshot.read("user_states") or b"{}").items()})
+    except Exception as e:
+        logger.error(f"Could not restore user states from snapshot: {e}")
 
 # Activity logging channel
 LOG_CHANNEL_ID = os.getenv("LOG_CHANNEL_ID")
 log_channel = None  # Will be set in on_ready
 
-# Track who added the bot to each server (guild_id -> user_id)
-import json
-INVITERS_FILE = "guild_inviters.json"
+# Durable state (inviters, warnings, notes, security settings) lives in SQLite in WAL mode. Reads are
+# served from in-memory caches; writes go to a queue that one writer thread commits in batches,
+# so nothing on the event loop ever waits on disk.
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "bot_state.db")
+INVITERS_FILE = "guild_inviters.json"  # pre-SQLite storage, imported once on first start
+STATE_WRITE_BATCH = 200  # max statements per transaction
+STATE_WRITE_LINGER_SECONDS = 0.05  # how long the writer waits to grow a batch
+STATE_NOTES_CACHE_USERS = 5000
+STATE_SCHEMA_VERSION = 1
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS guild_inviters (guild_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS user_warnings (
+    user_id INTEGER PRIMARY KEY,
+    warnings INTEGER NOT NULL,
+    last_spam_time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    note TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_notes_by_user ON user_notes (user_id, id);
+CREATE TABLE IF NOT EXISTS guild_security_settings (guild_id INTEGER PRIMARY KEY, settings TEXT NOT NULL);
+"""
+# Statements are constants so sqlite3's per-connection statement cache reuses the compiled form
+SQL_UPSERT_INVITER = "INSERT INTO guild_inviters (guild_id, user_id) VALUES (?, ?) ON CONFLICT (guild_id) DO UPDATE SET user_id = excluded.user_id"
+SQL_DELETE_INVITER = "DELETE FROM guild_inviters WHERE guild_id = ?"
+SQL_UPSERT_WARNING = ("INSERT INTO user_warnings (user_id, warnings, last_spam_time) VALUES (?, ?, ?) "
+                      "ON CONFLICT (user_id) DO UPDATE SET warnings = excluded.warnings, last_spam_time = excluded.last_spam_time")
+SQL_INSERT_NOTE = "INSERT INTO user_notes (user_id, note, created) VALUES (?, ?, ?)"
+SQL_SELECT_NOTES = "SELECT note FROM user_notes WHERE user_id = ? ORDER BY id"
+SQL_UPSERT_SECURITY = ("INSERT INTO guild_security_settings (guild_id, settings) VALUES (?, ?) "
+                       "ON CONFLICT (guild_id) DO UPDATE SET settings = excluded.settings")
+
+class StateStore:
+    """SQLite access split between a write-behind writer thread and a locked read connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writes = queue.Queue()
+        self.writer = None
+        self.read_conn = None
+        self.read_lock = threading.Lock()
+        self.batches = 0
+        self.statements = 0
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints; plenty for bot state
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def open(self):
+        """Create the schema and start the writer thread (blocking; call once at startup)."""
+        conn = self.connect()
+        with conn:
+            conn.executescript(STATE_SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)", (str(STATE_SCHEMA_VERSION),))
+        conn.close()
+        self.read_conn = self.connect()
+        self.writer = threading.Thread(target=self.write_loop, name="state-writer", daemon=True)
+        self.writer.start()
+
+    def execute(self, sql, params=()):
+        """Queue a write; it is committed with whatever else arrives in the same batch."""
+        self.writes.put((sql, params))
+
+    def query(self, sql, params=(), flush=False):
+        """Blocking read - at startup directly, on the event loop only via asyncio.to_thread.
+        flush=True first waits for queued writes, for reads that must see them."""
+        if flush:
+            self.flush()
+        with self.read_lock:
+            return self.read_conn.execute(sql, params).fetchall()
+
+    def write_loop(self):
+        conn = self.connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + STATE_WRITE_LINGER_SECONDS
+            while len(batch) < STATE_WRITE_BATCH and batch[-1] is not None and not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            statements = [op for op in batch if isinstance(op, tuple)]
+            if statements:
+                try:
+                    with conn:
+                        for sql, params in statements:
+                            conn.execute(sql, params)
+                    self.batches += 1
+                    self.statements += len(statements)
+                except Exception as e:
+                    logger.error(f"State store write failed ({len(statements)} statements dropped): {e}")
+            for op in batch:
+                if isinstance(op, threading.Event):
+                    op.set()  # flush() marker: everything queued before it is committed
+            if batch[-1] is None:
+                conn.close()
+                return
 
-def load_guild_inviters():
-    """Load guild inviters from file."""
-    try:
-        if os.path.exists(INVITERS_FILE):
-            with open(INVITERS_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading guild inviters: {e}")
-    return {}
+    def flush(self, timeout=10):
+        """Block until every write queued so far is committed."""
+        if self.writer is None or not self.writer.is_alive():
+            return
+        marker = threading.Event()
+        self.writes.put(marker)
+        marker.wait(timeout)
 
-def save_guild_inviters(inviters):
-    """Save guild inviters to file."""
+    def close(self, timeout=10):
+        """Commit pending writes and stop the writer thread (blocking)."""
+        if self.writer is not None and self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join(timeout)
+        if self.read_conn is not None:
+            self.read_conn.close()
+            self.read_conn = None
+
+state_store = StateStore(STATE_DB_FILE)  # opened by open_state_store() when the bot starts
+
+# Track who added the bot to each server (guild_id -> user_id)
+def import_legacy_inviters():
+    """One-time move of guild_inviters.json into SQLite (the file is renamed, not deleted)."""
+    if not os.path.exists(INVITERS_FILE):
+        return
     try:
-        with open(INVITERS_FILE, 'w') as f:
-            json.dump(inviters, f)
+        with open(INVITERS_FILE, 'r') as f:
+            inviters = json.load(f)
+        for guild_id, user_id in inviters.items():
+            state_store.execute(SQL_UPSERT_INVITER, (int(guild_id), user_id))
+        state_store.flush()
+        os.replace(INVITERS_FILE, INVITERS_FILE + ".migrated")
+        logger.info(f"Imported {len(inviters)} guild inviters from {INVITERS_FILE}")
     except Exception as e:
-        logger.error(f"Error saving guild inviters: {e}")
+        logger.error(f"Error importing guild inviters: {e}")
+
+def load_guild_inviters():
+    """Load guild inviters from the state store."""
+    import_legacy_inviters()
+    return {str(guild_id): user_id for guild_id, user_id in state_store.query("SELECT guild_id, user_id FROM guild_inviters")}
+
+def set_guild_inviter(guild_id, user_id):
+    guild_inviters[str(guild_id)] = user_id
+    state_store.execute(SQL_UPSERT_INVITER, (guild_id, user_id))
 
-guild_inviters = load_guild_inviters()  # {guild_id_str: user_id}
+def remove_guild_inviter(guild_id):
+    if guild_inviters.pop(str(guild_id), None) is not None:
+        state_store.execute(SQL_DELETE_INVITER, (guild_id,))
+
+guild_inviters = {}  # {guild_id_str: user_id}, filled by open_state_store()
+
+# Track user warnings for moderation (user_id: {"warnings": count, "last_spam_time": timestamp})
+user_warnings = {}
+
+def load_user_warnings():
+    return {
+        user_id: {"warnings": warnings, "last_spam_time": datetime.fromtimestamp(last_spam_time, timezone.utc)}
+        for user_id, warnings, last_spam_time in state_store.query("SELECT user_id, warnings, last_spam_time FROM user_warnings")
+    }
+
+def save_user_warning(user_id):
+    entry = user_warnings[user_id]
+    state_store.execute(SQL_UPSERT_WARNING, (user_id, entry["warnings"], entry["last_spam_time"].timestamp()))
+
+# Server security settings: guild_id: {"min_account_age_days": 7, "raid_alert_threshold": 5,
+#                                      "raid_windows": [[seconds, joins], ...]}
+guild_security_settings = {}
+
+def load_guild_security_settings():
+    return {
+        guild_id: json.loads(settings)
+        for guild_id, settings in state_store.query("SELECT guild_id, settings FROM guild_security_settings")
+    }
+
+def set_guild_security_setting(guild_id, key, value):
+    settings = guild_security_settings.setdefault(guild_id, {})
+    settings[key] = value
+    state_store.execute(SQL_UPSERT_SECURITY, (guild_id, json.dumps(settings)))
+
+def open_state_store():
+    """Open the database and load the in-memory caches (blocking; called once when the bot starts,
+    so importing this module never touches the working directory)."""
+    state_store.open()
+    guild_inviters.update(load_guild_inviters())
+    user_warnings.update(load_user_warnings())
+    guild_security_settings.update(load_guild_security_settings())
+    logger.info(f"Opened state store {STATE_DB_FILE}: {len(guild_inviters)} inviters, {len(user_warnings)} warned users, "
+                f"{len(guild_security_settings)} guild security settings")
+
+# Server security tracking. Raid detection keeps, per guild, one deque of join times (monotonic) for
+# each detection window: a join is appended once and expired from the left, so the cost of a join
+# stays flat however big the raid gets. Windows come from guild_security_settings.
+RAID_DEFAULT_WINDOWS = ((60, 5),)  # (window seconds, joins within it that look like a raid); more via !raidsettings
+RAID_ALERT_COOLDOWN_SECONDS = 120  # one alert per raid, not one per join
+RAID_MAX_WINDOWS = 5
+RAID_MAX_WINDOW_SECONDS = 3600  # joins are kept for the longest window, so bound it
+DEFAULT_MIN_ACCOUNT_AGE_DAYS = 7
+
+class JoinTracker:
+    """Sliding-window join counters for one guild."""
+    __slots__ = ("windows", "joins", "last_alert")
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.joins = [deque() for _ in windows]
+        self.last_alert = None
+
+    def record(self, now):
+        """Count a join at monotonic time `now`. Returns (window seconds, joins) for the first
+        window over its threshold, or None."""
+        tripped = None
+        for (seconds, threshold), joins in zip(self.windows, self.joins):
+            joins.append(now)
+            horizon = now - seconds
+            while joins[0] <= horizon:
+                joins.popleft()
+            if tripped is None and len(joins) >= threshold:
+                tripped = (seconds, len(joins))
+        return tripped
+
+    def should_alert(self, now):
+        if self.last_alert is not None and now - self.last_alert < RAID_ALERT_COOLDOWN_SECONDS:
+            return False
+        self.last_alert = now
+        return True
+
+guild_join_trackers = {}  # guild_id -> JoinTracker
+
+def get_raid_windows(guild_id):
+    settings = guild_security_settings.get(guild_id, {})
+    if settings.get("raid_windows"):
+        return tuple((min(int(seconds), RAID_MAX_WINDOW_SECONDS), int(joins)) for seconds, joins in settings["raid_windows"])
+    if settings.get("raid_alert_threshold"):
+        # Single-threshold form: joins per minute
+        return ((60, int(settings["raid_alert_threshold"])),)
+    return RAID_DEFAULT_WINDOWS
+
+def get_join_tracker(guild_id):
+    tracker = guild_join_trackers.get(guild_id)
+    if tracker is None:
+        tracker = guild_join_trackers[guild_id] = JoinTracker(get_raid_windows(guild_id))
+    return tracker
+
+# Notes are read through an LRU of users, loaded from SQLite on first access
+user_notes = OrderedDict()  # user_id -> [note, ...]
+
+async def get_user_notes(user_id):
+    notes = user_notes.get(user_id)
+    if notes is None:
+        rows = await asyncio.to_thread(state_store.query, SQL_SELECT_NOTES, (user_id,), True)
+        notes = user_notes.setdefault(user_id, [note for (note,) in rows])
+        while len(user_notes) > STATE_NOTES_CACHE_USERS:
+            user_notes.popitem(last=False)
+    user_notes.move_to_end(user_id)
+    return notes
+
+async def add_user_note(user_id, note_text):
+    notes = await get_user_notes(user_id)
+    notes.append(note_text)
+    state_store.execute(SQL_INSERT_NOTE, (user_id, note_text, time.time()))
+    return len(notes)
 
 async def log_activity(title, description, color=0x5865F2, fields=None):
     """Send activity log to the designated Discord channel."""
@@ -322,7 +1409,7 @@ Personality:
 Remember: You're not here to take disrespect. Give them what they deserve!"""
 
 def get_tutorial_prompt(software=None, brief=False):
-    """Get system prompt for tutorial/help questions."""
+    """Get system prompt for tutorial/help questions (only the software=None prompt is fixed)."""
     software_list = "After Effects, Premiere Pro, Photoshop, Media Encoder, DaVinci Resolve, Final Cut Pro, Topaz, CapCut, or something else?"
     if software and brief:
         return f"""You are "Editing Helper", created by BMR. The user wants help with {software}.
@@ -356,78 +1443,277 @@ DETAILED MODE - Provide comprehensive help:
 Ask them: "Which software would you like help with? (After Effects, Premiere Pro, Photoshop, DaVinci Resolve, Final Cut Pro, Topaz, CapCut, or something else?)"
 Wait for their answer."""
 
+system_prompt_cache.register(EDITING_SYSTEM_PROMPT, get_rude_system_prompt(), get_tutorial_prompt())
+
+# Shared HTTP client - one pooled session for the bot's lifetime so repeat fetches
+# (mostly the Discord CDN) reuse DNS lookups and keep-alive TLS connections
+HTTP_TOTAL_CONNECTIONS = 100
+HTTP_CONNECTIONS_PER_HOST = 20
+HTTP_DNS_CACHE_SECONDS = 300
+HTTP_KEEPALIVE_SECONDS = 60
+HTTP_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+
+http_session = None
+
+def get_http_session():
+    """Return the shared aiohttp session, creating it on first use."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_TOTAL_CONNECTIONS,
+            limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=HTTP_DEFAULT_TIMEOUT)
+    return http_session
+
+async def close_http_session():
+    """Close the shared aiohttp session and its pooled connections."""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# Graceful shutdown: event handlers and background work register here, so a SIGTERM can stop taking
+# new events, give in-flight work a deadline to finish, and report what had to be abandoned.
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SHUTDOWN_CANCEL_GRACE_SECONDS = 3  # how long cancelled tasks get to run their cleanup
+
+class Lifecycle:
+    """Registry of in-flight tasks, keyed by kind ("message", "gemini", "reminder", ...)."""
+
+    def __init__(self):
+        self.accepting = True
+        self.tasks = {}  # asyncio.Task -> kind
+        self.drained = Counter()  # kinds of tasks that finished after intake stopped
+        self.shutdown_task = None
+
+    def track(self, task, kind):
+        self.tasks[task] = kind
+        task.add_done_callback(self.forget)
+        return task
+
+    def forget(self, task):
+        kind = self.tasks.pop(task, None)
+        if not self.accepting and kind and not task.cancelled():
+            self.drained[kind] += 1
+
+    def spawn(self, coro, kind):
+        return self.track(asyncio.create_task(coro), kind)
+
+    def track_current(self, kind):
+        """Track the task running the caller, e.g. the one discord.py created for an event."""
+        task = asyncio.current_task()
+        if task is not None:
+            self.track(task, kind)
+
+    def pending(self):
+        current = asyncio.current_task()
+        return {task: kind for task, kind in self.tasks.items() if task is not current and not task.done()}
+
+    async def drain(self, deadline_seconds):
+        """Stop intake, wait for tracked work until the deadline, then cancel the rest.
+        
+        Returns (drained, abandoned) Counters of task kinds."""
+        self.accepting = False
+        abandoned = Counter()
+        deadline = time.monotonic() + deadline_seconds
+        # Work being drained can start more (a command spawning a Gemini call), so go round until idle
+        while (pending := self.pending()) and (remaining := deadline - time.monotonic()) > 0:
+            await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        leftover = self.pending()
+        if leftover:
+            abandoned.update(leftover.values())
+            for task in leftover:
+                task.cancel()
+            await asyncio.wait(leftover, timeout=SHUTDOWN_CANCEL_GRACE_SECONDS)
+        return self.drained, abandoned
+
+lifecycle = Lifecycle()
+
+# Normalized attachment images, so moderation and chat share one download + transcode per attachment
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+IMAGE_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_TTL_SECONDS", "900"))
+IMAGE_CACHE_MAX_URLS = 4096
+
+class ImageCache:
+    """Byte-bounded LRU of normalized JPEG bytes, addressed by URL and by content hash."""
+
+    def __init__(self, max_bytes, ttl_seconds, max_urls):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_urls = max_urls
+        self.images = OrderedDict()  # sha256 of downloaded bytes -> (jpeg bytes, stored_at)
+        self.url_digests = OrderedDict()  # url without query string -> sha256
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def url_key(url):
+        """Discord CDN URLs carry rotating signature params; the path alone identifies the attachment."""
+        return url.split('?', 1)[0]
+
+    def get_by_url(self, url):
+        digest = self.url_digests.get(self.url_key(url))
+        return self.get_by_digest(digest) if digest else None
+
+    def get_by_digest(self, digest):
+        entry = self.images.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            self._drop(digest)
+            self.misses += 1
+            return None
+        self.images.move_to_end(digest)
+        self.hits += 1
+        return data
+
+    def put(self, url, digest, data):
+        key = self.url_key(url)
+        self.url_digests[key] = digest
+        self.url_digests.move_to_end(key)
+        while len(self.url_digests) > self.max_urls:
+            self.url_digests.popitem(last=False)
+        if len(data) > self.max_bytes:
+            return
+        if digest in self.images:
+            self._drop(digest)
+        self.images[digest] = (data, time.monotonic())
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes:
+            self._drop(next(iter(self.images)))
+
+    def _drop(self, digest):
+        data, _ = self.images.pop(digest)
+        self.total_bytes -= len(data)
+
+image_cache = ImageCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL_SECONDS, IMAGE_CACHE_MAX_URLS)
+
+def normalize_image(image_data):
+    """Decode image bytes and re-encode as RGB JPEG for Gemini Vision (CPU-bound, run in a thread)."""
+    # Open with PIL to validate and get format, then convert to bytes
+    img = Image.open(io.BytesIO(image_data))
+    # Convert to RGB if necessary (for RGBA images)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    # Save to bytes buffer as JPEG
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
 async def download_image(url):
     """Download image from URL and return bytes for Gemini Vision."""
+    cached = image_cache.get_by_url(url)
+    if cached:
+        return cached
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    # Open with PIL to validate and get format, then convert to bytes
-                    img = Image.open(io.BytesIO(image_data))
-                    # Convert to RGB if necessary (for RGBA images)
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        img = img.convert('RGB')
-                    # Save to bytes buffer as JPEG
-                    buffer = io.BytesIO()
-                    img.save(buffer, format='JPEG', quality=85)
-                    buffer.seek(0)
-                    return buffer.getvalue()
+        async with get_http_session().get(url) as response:
+            if response.status == 200:
+                image_data = await response.read()
+                # Same bytes under a new URL (reposted meme) skip the transcode
+                digest = hashlib.sha256(image_data).hexdigest()
+                normalized = image_cache.get_by_digest(digest)
+                if normalized is None:
+                    normalized = await asyncio.to_thread(normalize_image, image_data)
+                image_cache.put(url, digest, normalized)
+                return normalized
     except Exception as e:
         logger.error(f"Error downloading image: {str(e)}")
     return None
 
+# Chunk sizes checked for repeated-pattern gibberish (like "asdasdasd")
+SPAM_PATTERN_LENGTHS = (2, 3)
+# Treat long messages that are >70% capitals as spam. Off by default: the original check never
+# actually fired, so turning it on starts deleting, warning and muting for shouting.
+SPAM_CAPS_CHECK = os.getenv("SPAM_CAPS_CHECK", "0") == "1"
+
+def has_repeated_pattern(msg_lower, freq):
+    """Check if a 2-3 char pattern from the start of the message fills >=60% of its chunks."""
+    length = len(msg_lower)
+    for pattern_len in SPAM_PATTERN_LENGTHS:
+        if length < pattern_len * 3:
+            continue
+        chunks = length // pattern_len
+        needed = chunks * 0.6
+        pattern_chars = set(msg_lower[:pattern_len])
+        
+        # A chunk counts if all of its chars come from the pattern; every stray char spoils at most one chunk
+        stray = sum(count for char, count in freq.items() if char not in pattern_chars)
+        stray -= sum(1 for char in msg_lower[chunks * pattern_len:] if char not in pattern_chars)
+        if chunks - stray >= needed:
+            return True
+        if chunks - -(-stray // pattern_len) < needed:
+            continue  # even packed together, the strays leave too few clean chunks
+        
+        # Undecided from counts alone - walk the chunks
+        clean = sum(1 for i in range(0, chunks * pattern_len, pattern_len)
+                    if pattern_chars.issuperset(msg_lower[i:i + pattern_len]))
+        if clean >= needed:
+            return True
+    return False
+
+def extract_spam_features(message_content):
+    """Compute every spam signal for a message from a single character count."""
+    msg_lower = message_content.lower().strip()
+    freq = Counter(msg_lower)
+    
+    non_space_total = len(msg_lower) - freq[' ']
+    max_char_count = max((count for char, count in freq.items() if char != ' '), default=0)
+    distinct_chars = len(freq) - (1 if ' ' in freq else 0)
+    letters = sum(count for char, count in freq.items() if char.isalpha())
+    
+    # Only count capitals when the caps rule is on and there are some (islower() is a fast C check)
+    caps = 0
+    if SPAM_CAPS_CHECK and letters and not message_content.islower():
+        caps = sum(map(str.isupper, message_content))
+    
+    return {
+        "msg_lower": msg_lower,
+        "length": len(msg_lower),
+        "distinct_chars": distinct_chars,
+        "dominant_ratio": max_char_count / non_space_total if non_space_total else 0,
+        "repeated_pattern": len(msg_lower) > 5 and has_repeated_pattern(msg_lower, freq),
+        "caps_ratio": caps / letters if letters else 0,
+        "mentions": freq['@'],
+        "emojis": sum(count for char, count in freq.items() if ord(char) > 0x1F300),
+    }
+
 def detect_spam(message_content):
     """Detect if message is spam."""
-    msg_lower = message_content.lower().strip()
+    features = extract_spam_features(message_content)
+    length = features["length"]
     
     # Ignore short messages or empty
-    if len(msg_lower) < 3:
+    if length < 3:
         return False, None
     
     # 1. Repeated same character (e.g., "aaaaaaa")
-    if len(msg_lower) > 5 and len(set(msg_lower.replace(' ', ''))) == 1:
+    if length > 5 and features["distinct_chars"] == 1:
         return True, "Repeated characters spam"
     
     # 2. Mostly one character (>50% same character) - catches "asssadadadasssdadada"
-    char_freq = {}
-    for char in msg_lower:
-        if char != ' ':
-            char_freq[char] = char_freq.get(char, 0) + 1
-    
-    if char_freq:
-        max_char_count = max(char_freq.values())
-        total_chars = sum(char_freq.values())
-        if max_char_count / total_chars > 0.5:  # >50% is one character = spam
-            return True, "Excessive repeated character spam"
-    
-    # 3. Gibberish detection - checking for repeated pattern spam (like "asdasdasd")
-    if len(msg_lower) > 5:
-        # Check for repeated 2-3 char patterns (like "asdasdasd" or "asdaasdaasd")
-        for pattern_len in [2, 3]:
-            if len(msg_lower) >= pattern_len * 3:
-                pattern = msg_lower[:pattern_len]
-                # Count how many times the pattern repeats
-                repeats = 0
-                for i in range(0, len(msg_lower) - pattern_len + 1, pattern_len):
-                    if msg_lower[i:i+pattern_len] == pattern or all(c in pattern for c in msg_lower[i:i+pattern_len]):
-                        repeats += 1
-                
-                # If pattern repeats >60% of the message = spam
-                if repeats >= len(msg_lower) // pattern_len * 0.6:
-                    return True, "Gibberish spam"
-    
-    # 4. Excessive caps (>70% caps in long message)
-    if len(msg_lower) > 10 and message_content.count(message_content.upper()) / len(message_content) > 0.7:
+    if features["dominant_ratio"] > 0.5:
+        return True, "Excessive repeated character spam"
+    
+    # 3. Gibberish detection - repeated 2-3 char patterns (like "asdasdasd" or "asdaasdaasd")
+    if features["repeated_pattern"]:
+        return True, "Gibberish spam"
+    
+    # 4. Excessive caps (>70% of letters uppercase in long message), only with SPAM_CAPS_CHECK=1
+    if SPAM_CAPS_CHECK and length > 10 and features["caps_ratio"] > 0.7:
         return True, "Excessive caps spam"
     
     # 5. Excessive mentions (>3 mentions)
-    if message_content.count('@') > 3:
+    if features["mentions"] > 3:
         return True, "Excessive mentions spam"
     
     # 6. Excessive emojis (>5 emojis in short message)
-    emoji_count = len([c for c in message_content if ord(c) > 0x1F300])
-    if emoji_count > 5 and len(msg_lower) < 20:
+    if features["emojis"] > 5 and length < 20:
         return True, "Excessive emojis spam"
     
     return False, None
@@ -443,8 +1729,8 @@ async def timeout_user(user, guild, hours=24):
         logger.error(f"Error timing out user: {str(e)}")
         return False
 
-async def check_and_moderate_spam(message):
-    """Check if message is spam and handle moderation."""
+async def check_and_moderate_spam(message, verdict=None):
+    """Check if message is spam and handle moderation. Pass a precomputed detect_spam verdict to skip detection."""
     try:
         # Don't moderate BMR, bot, or DMs
         if message.author == bot.user or 'bmr' in message.author.name.lower():
@@ -452,7 +1738,7 @@ async def check_and_moderate_spam(message):
         if isinstance(message.channel, discord.DMChannel):
             return
         
-        is_spam, spam_reason = detect_spam(message.content)
+        is_spam, spam_reason = verdict if verdict is not None else detect_spam(message.content)
         if not is_spam:
             return
         
@@ -472,6 +1758,7 @@ async def check_and_moderate_spam(message):
             user_warnings[user_id]["warnings"] = 1
         
         user_warnings[user_id]["last_spam_time"] = current_time
+        save_user_warning(user_id)
         
         # Delete the spam message
         try:
@@ -506,23 +1793,17 @@ async def check_and_moderate_spam(message):
                 pass  # DMs may be closed
             # Reset warnings after mute
             user_warnings[user_id]["warnings"] = 0
+            save_user_warning(user_id)
             logger.info(f"Muted {message.author.name} for 24 hours due to spam")
     
     except Exception as e:
         logger.error(f"Error in spam moderation: {str(e)}")
 
+INVITE_LINK_RE = re.compile(r'discord\.gg/[a-zA-Z0-9]+|discord\.com/invite/[a-zA-Z0-9]+|discordapp\.com/invite/[a-zA-Z0-9]+', re.IGNORECASE)
+
 def detect_invite_links(content):
     """Detect Discord invite links in message."""
-    import re
-    invite_patterns = [
-        r'discord\.gg/[a-zA-Z0-9]+',
-        r'discord\.com/invite/[a-zA-Z0-9]+',
-        r'discordapp\.com/invite/[a-zA-Z0-9]+',
-    ]
-    for pattern in invite_patterns:
-        if re.search(pattern, content, re.IGNORECASE):
-            return True
-    return False
+    return INVITE_LINK_RE.search(content) is not None
 
 SLUR_PATTERNS = [
     r'n+[i1!]+[g9]+[a@4]+[s$]*',
@@ -541,30 +1822,49 @@ SLUR_PATTERNS = [
     r'a+[s$]+[s$]+[h]+[o0]+[l1]+[e3]+[s$]*',
 ]
 
+# Compiled once at import: detect_profanity runs on every non-bot message in every guild
+PROFANITY_TOKEN_RE = re.compile(r'\w+')
+PROFANITY_PHRASE_RE = re.compile('|'.join(re.escape(p) for p in sorted(PROFANITY_WORDS) if ' ' in p))
+PROFANITY_STRIP_RE = re.compile(r'[^a-z0-9\s]| ')  # same as dropping non-alphanumerics, then spaces
+SLUR_REGEXES = [re.compile(pattern) for pattern in SLUR_PATTERNS]
+
+def compile_slur_prefilter(patterns):
+    """Combine slur patterns into one regex whose branches start with a literal letter."""
+    # Every pattern starts with '<letter>+'; rewriting that as '<letter><letter>*' and grouping by
+    # letter lets re jump straight to candidate positions instead of trying all 14 patterns everywhere
+    branches = {}
+    for pattern in patterns:
+        branches.setdefault(pattern[0], []).append(pattern[2:])
+    return re.compile('|'.join(f"{letter}{letter}*(?:{'|'.join(rest)})" for letter, rest in branches.items()))
+
+SLUR_COMBINED_RE = compile_slur_prefilter(SLUR_PATTERNS)
+
 def detect_profanity(content):
     """Detect profanity in message content with fuzzy matching for variations."""
     content_lower = content.lower()
-    content_normalized = re.sub(r'[^a-z0-9\s]', '', content_lower)
-    content_no_spaces = content_normalized.replace(' ', '')
     
-    words = re.findall(r'\b\w+\b', content_lower)
-    for word in words:
-        if word in PROFANITY_WORDS:
-            return True, word
+    words = PROFANITY_TOKEN_RE.findall(content_lower)
+    if not PROFANITY_WORDS.isdisjoint(words):
+        for word in words:
+            if word in PROFANITY_WORDS:
+                return True, word
     
-    for phrase in PROFANITY_WORDS:
-        if ' ' in phrase and phrase in content_lower:
-            return True, phrase
+    phrase_match = PROFANITY_PHRASE_RE.search(content_lower)
+    if phrase_match:
+        return True, phrase_match.group()
     
-    for pattern in SLUR_PATTERNS:
-        if re.search(pattern, content_no_spaces, re.IGNORECASE):
-            match = re.search(pattern, content_no_spaces, re.IGNORECASE)
-            return True, match.group() if match else "slur variation"
+    content_no_spaces = PROFANITY_STRIP_RE.sub('', content_lower)
+    if SLUR_COMBINED_RE.search(content_no_spaces):
+        # Rare path: report the first pattern in list order, as before
+        for slur_re in SLUR_REGEXES:
+            match = slur_re.search(content_no_spaces)
+            if match:
+                return True, match.group()
     
     return False, None
 
-async def moderate_profanity(message):
-    """Check for profanity and take moderation action - delete, warn, and mute for 24h."""
+async def moderate_profanity(message, verdict=None):
+    """Check for profanity and take moderation action - delete, warn, and mute for 24h. Pass a precomputed detect_profanity verdict to skip detection."""
     try:
         if message.author == bot.user or 'bmr' in message.author.name.lower():
             return False
@@ -573,7 +1873,7 @@ async def moderate_profanity(message):
         if hasattr(message.author, 'guild_permissions') and message.author.guild_permissions.administrator:
             return False
         
-        has_profanity, bad_word = detect_profanity(message.content)
+        has_profanity, bad_word = verdict if verdict is not None else detect_profanity(message.content)
         if not has_profanity:
             return False
         
@@ -603,6 +1903,161 @@ async def moderate_profanity(message):
         logger.error(f"Error in profanity moderation: {str(e)}")
         return False
 
+# Image moderation verdicts, keyed by content hash, with a perceptual-hash fallback so reposts and
+# re-encodes of an image already judged safe skip the LLM
+MODERATION_CACHE_TOLERANCE = int(os.getenv("MODERATION_CACHE_TOLERANCE", "4"))  # max differing dHash bits
+MODERATION_CACHE_TTL_SECONDS = int(os.getenv("MODERATION_CACHE_TTL_SECONDS", str(24 * 3600)))
+MODERATION_CACHE_MAX_ENTRIES = int(os.getenv("MODERATION_CACHE_MAX_ENTRIES", "50000"))
+MODERATION_CACHE_FILE = os.getenv("MODERATION_CACHE_FILE")  # optional JSON persistence
+# Flat and low-detail images (plain fills, a faint shape, a small box of text) all hash to nearly
+# 0 or nearly all ones, so they would match each other; those only ever match their exact bytes
+MODERATION_CACHE_MIN_HASH_BITS = 12
+
+def compute_dhash(image_data):
+    """64-bit difference hash: compares neighbouring pixels of a 9x8 grayscale thumbnail."""
+    img = Image.open(io.BytesIO(image_data))
+    img.draft('L', (64, 64))  # let the JPEG decoder downscale while decoding
+    pixels = img.convert('L').resize((9, 8), Image.Resampling.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def compute_moderation_keys(image_data):
+    """(sha256 hex of the bytes, dHash) for ModerationVerdictCache (blocking; run in a thread)."""
+    return hashlib.sha256(image_data).hexdigest(), compute_dhash(image_data)
+
+def is_detailed_hash(image_hash):
+    return MODERATION_CACHE_MIN_HASH_BITS <= image_hash.bit_count() <= 64 - MODERATION_CACHE_MIN_HASH_BITS
+
+class ModerationVerdictCache:
+    """LRU of (is_bad, reason) verdicts keyed by content sha256.
+    
+    An exact content match returns any verdict. A near match (dHash within `tolerance` bits) only
+    ever returns a "safe" verdict, and only for detailed images: a near-duplicate is never deleted
+    or punished on the strength of another image's verdict."""
+
+    def __init__(self, tolerance, ttl_seconds, max_entries):
+        self.tolerance = tolerance
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.verdicts = OrderedDict()  # content sha -> (image_hash, is_bad, reason, stored_at)
+        # Safe, detailed entries are indexed by hash bands: split hashes into tolerance+1 bands and
+        # any hash within `tolerance` bits matches at least one band exactly (pigeonhole), so
+        # lookups only compare a few candidates
+        self.band_count = tolerance + 1
+        self.band_bits = -(-64 // self.band_count)
+        self.bands = [{} for _ in range(self.band_count)]  # band value -> set of content shas
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def _band_values(self, image_hash):
+        mask = (1 << self.band_bits) - 1
+        return [(image_hash >> (i * self.band_bits)) & mask for i in range(self.band_count)]
+
+    def _expired(self, content_sha, now):
+        if now - self.verdicts[content_sha][3] > self.ttl_seconds:
+            self._drop(content_sha)
+            return True
+        return False
+
+    def get(self, content_sha, image_hash):
+        """Return the cached (is_bad, reason) for these bytes, or "safe" for a near-identical
+        detailed image judged safe; None otherwise."""
+        now = time.time()
+        match = None
+        if content_sha in self.verdicts and not self._expired(content_sha, now):
+            match = content_sha
+        elif is_detailed_hash(image_hash):
+            best_distance = None
+            candidates = set()
+            for band, value in zip(self.bands, self._band_values(image_hash)):
+                candidates.update(band.get(value, ()))
+            for candidate in candidates:
+                distance = (self.verdicts[candidate][0] ^ image_hash).bit_count()
+                if distance > self.tolerance or self._expired(candidate, now):
+                    continue
+                if best_distance is None or distance < best_distance:
+                    best_distance, match = distance, candidate
+        if match is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.verdicts.move_to_end(match)
+        _, is_bad, reason, _ = self.verdicts[match]
+        return is_bad, reason
+
+    def put(self, content_sha, image_hash, is_bad, reason, stored_at=None):
+        if content_sha in self.verdicts:
+            self._drop(content_sha)
+        self.verdicts[content_sha] = (image_hash, is_bad, reason, stored_at or time.time())
+        if not is_bad and is_detailed_hash(image_hash):
+            for band, value in zip(self.bands, self._band_values(image_hash)):
+                band.setdefault(value, set()).add(content_sha)
+        while len(self.verdicts) > self.max_entries:
+            self._drop(next(iter(self.verdicts)))
+        self.dirty = True
+
+    def _drop(self, content_sha):
+        image_hash = self.verdicts.pop(content_sha)[0]
+        for band, value in zip(self.bands, self._band_values(image_hash)):
+            members = band.get(value)
+            if members:
+                members.discard(content_sha)
+                if not members:
+                    del band[value]
+        self.dirty = True
+
+    def load(self, path):
+        """Load persisted verdicts from a JSON file, skipping expired ones."""
+        try:
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get("version") != 2:
+                    # Version 1 was keyed by dHash alone; without content hashes it can't be reused safely
+                    logger.info(f"Ignoring moderation verdicts in old format from {path}")
+                    return
+                now = time.time()
+                for content_sha, hash_hex, is_bad, reason, stored_at in data.get("verdicts", []):
+                    if now - stored_at <= self.ttl_seconds:
+                        self.put(content_sha, int(hash_hex, 16), is_bad, reason, stored_at)
+                self.dirty = False
+                logger.info(f"Loaded {len(self.verdicts)} image moderation verdicts from {path}")
+        except Exception as e:
+            logger.error(f"Error loading moderation verdict cache: {e}")
+
+    def snapshot(self):
+        """Copy the verdicts for saving (on the event loop, so nothing changes mid-copy). Clearing
+        dirty first means a verdict added while the write runs is saved next time."""
+        self.dirty = False
+        return [[sha, f"{h:016x}", is_bad, reason, stored_at] for sha, (h, is_bad, reason, stored_at) in self.verdicts.items()]
+
+    def write(self, path, entries):
+        """Write a snapshot() to a JSON file (blocking; call via asyncio.to_thread)."""
+        try:
+            with open(path + ".tmp", 'w') as f:
+                json.dump({"version": 2, "verdicts": entries}, f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            self.dirty = True
+            logger.error(f"Error saving moderation verdict cache: {e}")
+
+    def save(self, path):
+        self.write(path, self.snapshot())
+
+moderation_cache = ModerationVerdictCache(MODERATION_CACHE_TOLERANCE, MODERATION_CACHE_TTL_SECONDS, MODERATION_CACHE_MAX_ENTRIES)
+if MODERATION_CACHE_FILE:
+    moderation_cache.load(MODERATION_CACHE_FILE)
+
+@tasks.loop(minutes=5)
+async def save_moderation_cache():
+    """Periodically persist the verdict cache when persistence is enabled."""
+    if MODERATION_CACHE_FILE and moderation_cache.dirty:
+        await asyncio.to_thread(moderation_cache.write, MODERATION_CACHE_FILE, moderation_cache.snapshot())
+
 async def analyze_image_content(image_url):
     """Use Gemini to analyze if an image contains inappropriate content."""
     try:
@@ -610,17 +2065,21 @@ async def analyze_image_content(image_url):
         if not image_data:
             return False, None
         
-        import base64
-        image_b64 = base64.b64encode(image_data).decode('utf-8')
+        content_sha, image_hash = await asyncio.to_thread(compute_moderation_keys, image_data)
+        cached = moderation_cache.get(content_sha, image_hash)
+        if cached is not None:
+            return cached
         
-        response = gemini_client.models.generate_content(
-            model="gemini-2.0-flash",
+        # Moderation draws only on the global bucket and goes ahead of any queued chat or creative work
+        await admission.acquire(None, None, PRIORITY_MODERATION)
+        response = await gemini_generate(
+            task=TASK_MODERATION,
             contents=[
                 types.Content(
                     role="user",
                     parts=[
                         types.Part.from_bytes(data=image_data, mime_type="image/jpeg"),
-                        types.Part.from_text("Analyze this image. Is it inappropriate, NSFW, contains nudity, violence, gore, hate symbols, or explicit content? Reply with ONLY 'YES' or 'NO' followed by a brief reason.")
+                        types.Part.from_text(text="Analyze this image. Is it inappropriate, NSFW, contains nudity, violence, gore, hate symbols, or explicit content? Reply with ONLY 'YES' or 'NO' followed by a brief reason.")
                     ]
                 )
             ]
@@ -629,12 +2088,17 @@ async def analyze_image_content(image_url):
         result = response.text.strip().upper()
         is_bad = result.startswith('YES')
         reason = response.text.strip() if is_bad else None
+        moderation_cache.put(content_sha, image_hash, is_bad, reason)
         return is_bad, reason
         
     except Exception as e:
         logger.error(f"Error analyzing image: {str(e)}")
         return False, None
 
+# Max image checks running at once per guild, so one raid can't monopolise moderation for everyone
+IMAGE_MODERATION_CONCURRENCY_PER_GUILD = int(os.getenv("IMAGE_MODERATION_CONCURRENCY_PER_GUILD", "4"))
+guild_image_semaphores = {}  # guild_id -> asyncio.Semaphore
+
 async def moderate_images(message):
     """Check images/attachments for inappropriate content."""
     try:
@@ -643,31 +2107,51 @@ async def moderate_images(message):
         if isinstance(message.channel, discord.DMChannel):
             return False
         
-        for attachment in message.attachments:
-            if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']):
-                is_bad, reason = await analyze_image_content(attachment.url)
+        image_urls = [attachment.url for attachment in message.attachments
+                      if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp'])]
+        if not image_urls:
+            return False
+        
+        # Check every image at once (capped per guild); stop as soon as one is flagged
+        semaphore = guild_image_semaphores.setdefault(message.guild.id, asyncio.Semaphore(IMAGE_MODERATION_CONCURRENCY_PER_GUILD))
+        
+        async def check_image(url):
+            async with semaphore:
+                return await analyze_image_content(url)
+        
+        checks = [asyncio.ensure_future(check_image(url)) for url in image_urls]
+        is_bad, reason = False, None
+        try:
+            for next_done in asyncio.as_completed(checks):
+                is_bad, reason = await next_done
                 if is_bad:
-                    try:
-                        await message.delete()
-                        logger.info(f"Deleted inappropriate image from {message.author.name}: {reason}")
-                    except:
-                        pass
-                    
-                    await message.channel.send(f"🚫 {message.author.mention} - Your image was removed for containing inappropriate content. You have been muted for 24 hours.", delete_after=10)
-                    
-                    try:
-                        timeout_duration = timedelta(hours=24)
-                        await message.author.timeout(timeout_duration, reason="Posted inappropriate image")
-                        logger.info(f"Muted {message.author.name} for 24 hours for inappropriate image")
-                    except Exception as e:
-                        logger.error(f"Could not mute user: {e}")
-                    
-                    try:
-                        await message.author.send(f"🔇 You've been **muted for 24 hours** in {message.guild.name} for posting inappropriate images. Please follow server rules.")
-                    except:
-                        pass
-                    
-                    return True
+                    break
+        finally:
+            for check in checks:
+                check.cancel()
+        
+        if is_bad:
+            try:
+                await message.delete()
+                logger.info(f"Deleted inappropriate image from {message.author.name}: {reason}")
+            except:
+                pass
+            
+            await message.channel.send(f"🚫 {message.author.mention} - Your image was removed for containing inappropriate content. You have been muted for 24 hours.", delete_after=10)
+            
+            try:
+                timeout_duration = timedelta(hours=24)
+                await message.author.timeout(timeout_duration, reason="Posted inappropriate image")
+                logger.info(f"Muted {message.author.name} for 24 hours for inappropriate image")
+            except Exception as e:
+                logger.error(f"Could not mute user: {e}")
+            
+            try:
+                await message.author.send(f"🔇 You've been **muted for 24 hours** in {message.guild.name} for posting inappropriate images. Please follow server rules.")
+            except:
+                pass
+            
+            return True
         
         return False
         
@@ -675,8 +2159,8 @@ async def moderate_images(message):
         logger.error(f"Error in image moderation: {str(e)}")
         return False
 
-async def check_server_security(message):
-    """Monitor server security threats like invites and suspicious behavior."""
+async def check_server_security(message, has_invite=None):
+    """Monitor server security threats like invites and suspicious behavior. Pass has_invite to skip detection."""
     try:
         if message.author == bot.user or 'bmr' in message.author.name.lower():
             return
@@ -684,7 +2168,9 @@ async def check_server_security(message):
             return
         
         # Check for invite links
-        if detect_invite_links(message.content):
+        if has_invite is None:
+            has_invite = detect_invite_links(message.content)
+        if has_invite:
             try:
                 await message.delete()
                 await message.channel.send(f"🔒 {message.author.mention} - Posting invite links is not allowed in this server.")
@@ -699,31 +2185,24 @@ async def check_server_security(message):
 @bot.event
 async def on_member_join(member):
     """Handle member join - check for raids and account age."""
+    if not lifecycle.accepting:
+        return
+    lifecycle.track_current("member_join")
     try:
         guild = member.guild
         guild_id = guild.id
-        
-        # Initialize guild tracking if needed
-        if guild_id not in guild_join_history:
-            guild_join_history[guild_id] = []
-        
-        # Add join to history
         current_time = datetime.now(timezone.utc)
-        guild_join_history[guild_id].append({"user_id": member.id, "timestamp": current_time})
-        
-        # Clean old entries (older than 2 minutes)
-        two_min_ago = current_time - timedelta(minutes=2)
-        guild_join_history[guild_id] = [j for j in guild_join_history[guild_id] if j["timestamp"] > two_min_ago]
         
-        # ANTI-RAID: Check for simultaneous joins (5+ users joining at same time)
-        # Check joins within last 1 minute for simultaneous activity
-        one_min_ago = current_time - timedelta(minutes=1)
-        simultaneous_joins = [j for j in guild_join_history[guild_id] if j["timestamp"] > one_min_ago]
+        # ANTI-RAID: any window over its join threshold (e.g. 5+ joins within a minute)
+        tracker = get_join_tracker(guild_id)
+        now = time.monotonic()
+        tripped = tracker.record(now)
         
-        if len(simultaneous_joins) >= 5:  # 5+ joins within 1 minute = suspicious simultaneous activity
+        if tripped and tracker.should_alert(now):
+            window_seconds, joins = tripped
             embed = discord.Embed(
                 title="🚨 POTENTIAL RAID DETECTED",
-                description=f"**{len(simultaneous_joins)} users joined simultaneously in the last minute**\n\nLatest: {member.mention}",
+                description=f"**{joins} users joined in the last {format_duration(window_seconds)}**\n\nLatest: {member.mention}",
                 color=discord.Color.red()
             )
             # Send to mod-log or first available channel
@@ -733,11 +2212,12 @@ async def on_member_join(member):
                         await channel.send(embed=embed)
                     except:
                         pass
-            logger.warning(f"Potential raid detected in {guild.name}: {len(simultaneous_joins)} simultaneous joins in 1 minute")
+            logger.warning(f"Potential raid detected in {guild.name}: {joins} joins in {format_duration(window_seconds)}")
         
         # ACCOUNT AGE CHECK: Warn if new account
         account_age = current_time - member.created_at
-        if account_age.days < 7:  # Account less than 7 days old
+        min_age_days = guild_security_settings.get(guild_id, {}).get("min_account_age_days", DEFAULT_MIN_ACCOUNT_AGE_DAYS)
+        if account_age.days < min_age_days:
             embed = discord.Embed(
                 title="⚠️ New Account Join",
                 description=f"{member.mention} joined with a **{account_age.days}-day-old** account",
@@ -765,40 +2245,260 @@ async def on_webhooks_update(channel):
     """Monitor webhook creation/deletion."""
     logger.warning(f"Webhook update in {channel.guild.name}#{channel.name} - potential security concern")
 
-async def download_video(url, filename):
-    """Download video from URL and return bytes for Gemini Video analysis."""
+# Videos are streamed to a spooled temp file and uploaded through the Gemini Files API, so a large
+# attachment is never held in memory whole (and is never base64-inlined into a request)
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_BYTES", str(100 * 1024 * 1024)))
+VIDEO_SPOOL_MEMORY_BYTES = 8 * 1024 * 1024  # smaller videos never touch disk
+VIDEO_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+VIDEO_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=30)
+VIDEO_PROCESSING_POLL_SECONDS = 2
+VIDEO_PROCESSING_TIMEOUT_SECONDS = int(os.getenv("VIDEO_PROCESSING_TIMEOUT_SECONDS", "180"))
+VIDEO_FILE_REUSE_SECONDS = 47 * 3600  # Gemini deletes uploaded files after 48 hours
+VIDEO_FILE_MAX_HANDLES = 1000
+VIDEO_MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.avi': 'video/avi',
+    '.mkv': 'video/x-matroska',
+    '.webm': 'video/webm',
+    '.mov': 'video/quicktime',
+    '.flv': 'video/x-flv',
+    '.wmv': 'video/x-ms-wmv',
+    '.m4v': 'video/mp4'
+}
+
+def video_mime_type(filename):
+    return VIDEO_MIME_TYPES.get('.' + filename.split('.')[-1].lower(), 'video/mp4')
+
+async def download_video(url, filename, size=None, to_disk=False):
+    """Stream a video attachment into a spooled temp file (a named file on disk if to_disk, for tools
+    that need a path). Returns (file object at offset 0, error)."""
+    # Check if it's a .mov file - reject it
+    if filename.lower().endswith('.mov'):
+        return None, "MOV files are not supported"
+    max_mb = VIDEO_MAX_BYTES // (1024 * 1024)
+    if size and size > VIDEO_MAX_BYTES:
+        return None, f"Video is too large (max {max_mb} MB)"
+    
+    if to_disk:
+        spool = tempfile.NamedTemporaryFile(suffix='.' + filename.split('.')[-1].lower())
+    else:
+        spool = tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_MEMORY_BYTES)
     try:
-        # Check if it's a .mov file - reject it
-        if filename.lower().endswith('.mov'):
-            return None, "MOV files are not supported"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    video_data = await response.read()
-                    return video_data, None
+        async with get_http_session().get(url, timeout=VIDEO_DOWNLOAD_TIMEOUT) as response:
+            if response.status != 200:
+                spool.close()
+                return None, f"Couldn't download the video (HTTP {response.status})"
+            received = 0
+            async for chunk in response.content.iter_chunked(VIDEO_DOWNLOAD_CHUNK_BYTES):
+                received += len(chunk)
+                if received > VIDEO_MAX_BYTES:
+                    spool.close()
+                    return None, f"Video is too large (max {max_mb} MB)"
+                # Past the in-memory threshold this is a disk write
+                await asyncio.to_thread(spool.write, chunk)
+        spool.seek(0)
+        return spool, None
     except Exception as e:
+        spool.close()
         logger.error(f"Error downloading video: {str(e)}")
-    return None, str(e)
-
-async def analyze_video(video_bytes, filename, user_id):
-    """Analyze video and provide editing steps using Gemini."""
+        return None, str(e)
+
+async def upload_video(spool, filename):
+    """Upload a video to the Files API and wait (without blocking the loop) until Gemini can use it."""
+    # A NamedTemporaryFile is a wrapper, not an io.IOBase; the SDK needs the file object underneath
+    video_file = await gemini_client.aio.files.upload(
+        file=getattr(spool, "file", spool),
+        config=types.UploadFileConfig(mime_type=video_mime_type(filename), display_name=filename)
+    )
+    deadline = time.monotonic() + VIDEO_PROCESSING_TIMEOUT_SECONDS
+    while video_file.state == types.FileState.PROCESSING:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini is still processing {filename} after {VIDEO_PROCESSING_TIMEOUT_SECONDS}s")
+        await asyncio.sleep(VIDEO_PROCESSING_POLL_SECONDS)
+        video_file = await gemini_client.aio.files.get(name=video_file.name)
+    if video_file.state == types.FileState.FAILED:
+        raise RuntimeError(f"Gemini couldn't process {filename}")
+    return video_file
+
+# Keyframe pre-pass: for most "how do I edit this" questions a handful of scene-change frames plus
+# the stream metadata answer as well as the whole file, for a fraction of the upload and latency.
+# VIDEO_ANALYSIS_MODE: "auto" (keyframes unless the question needs sound or motion), "keyframes", or "full"
+VIDEO_MODE_FULL = "full"
+VIDEO_MODE_KEYFRAMES = "keyframes"
+VIDEO_ANALYSIS_MODE = os.getenv("VIDEO_ANALYSIS_MODE", "auto")
+VIDEO_KEYFRAME_COUNT = int(os.getenv("VIDEO_KEYFRAME_COUNT", "8"))
+VIDEO_SCENE_THRESHOLD = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.3"))  # ffmpeg scene score, 0-1
+VIDEO_KEYFRAME_MAX_SIDE = 768
+VIDEO_KEYFRAME_WORKERS = int(os.getenv("VIDEO_KEYFRAME_WORKERS", "2"))  # extractions running ffmpeg at once
+VIDEO_KEYFRAME_TIMEOUT_SECONDS = 120
+VIDEO_KEYFRAME_CACHE_ENTRIES = 32
+FULL_VIDEO_KEYWORDS = ('audio', 'sound', 'music', 'voice', 'beat', 'sync', 'transition', 'motion', 'pacing', 'full video', 'whole video')
+# The pre-pass shells out to ffmpeg/ffprobe; without them every video is analysed in full
+FFMPEG_AVAILABLE = bool(shutil.which("ffmpeg") and shutil.which("ffprobe"))
+keyframe_semaphore = asyncio.Semaphore(VIDEO_KEYFRAME_WORKERS)
+
+def choose_video_mode(prompt):
+    if VIDEO_ANALYSIS_MODE == VIDEO_MODE_FULL or not FFMPEG_AVAILABLE:
+        return VIDEO_MODE_FULL
+    if VIDEO_ANALYSIS_MODE != VIDEO_MODE_KEYFRAMES and any(keyword in prompt.lower() for keyword in FULL_VIDEO_KEYWORDS):
+        return VIDEO_MODE_FULL
+    return VIDEO_MODE_KEYFRAMES
+
+class KeyframeSample:
+    __slots__ = ("metadata", "frames")
+
+    def __init__(self, metadata, frames):
+        self.metadata = metadata  # duration, width, height, fps, bitrate, codec, has_audio
+        self.frames = frames  # JPEG bytes, in time order
+
+async def run_media_tool(*args):
+    """Run ffmpeg/ffprobe as an asyncio subprocess and return its stdout; killed on timeout or cancel."""
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
     try:
-        # Determine mime type based on file extension
-        mime_types = {
-            '.mp4': 'video/mp4',
-            '.avi': 'video/avi',
-            '.mkv': 'video/x-matroska',
-            '.webm': 'video/webm',
-            '.mov': 'video/quicktime',
-            '.flv': 'video/x-flv',
-            '.wmv': 'video/x-ms-wmv',
-            '.m4v': 'video/mp4'
+        stdout, stderr = await asyncio.wait_for(process.communicate(), VIDEO_KEYFRAME_TIMEOUT_SECONDS)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} exited with {process.returncode}: {stderr.decode(errors='replace').strip()[-300:]}")
+    return stdout
+
+async def run_ffmpeg_frames(path, video_filter, count, pattern):
+    await run_media_tool(
+        "ffmpeg", "-v", "error", "-i", path, "-vf", video_filter, "-vsync", "vfr", "-frames:v", str(count), "-q:v", "4", pattern
+    )
+
+def read_files(paths):
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    return images
+
+async def extract_keyframes(path, count, scene_threshold, max_side):
+    """Probe a video and pull up to `count` keyframes as JPEGs.
+    
+    Frames come from scene changes first; shots with few cuts are topped up with evenly spaced frames.
+    The decoding happens in ffmpeg child processes; keyframe_semaphore bounds how many run at once."""
+    async with keyframe_semaphore:
+        probe = await run_media_tool("ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path)
+        info = json.loads(probe)
+        streams = info.get("streams", [])
+        video = next((stream for stream in streams if stream.get("codec_type") == "video"), None)
+        if video is None:
+            raise ValueError("no video stream")
+        container = info.get("format", {})
+        duration = float(container.get("duration") or video.get("duration") or 0)
+        numerator, _, denominator = (video.get("avg_frame_rate") or "0/1").partition("/")
+        fps = float(numerator) / float(denominator) if float(denominator or 0) else 0.0
+        metadata = {
+            "duration": round(duration, 2),
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "fps": round(fps, 2),
+            "bitrate": int(container.get("bit_rate") or 0),
+            "codec": video.get("codec_name"),
+            "has_audio": any(stream.get("codec_type") == "audio" for stream in streams),
         }
         
-        file_ext = '.' + filename.split('.')[-1].lower()
-        mime_type = mime_types.get(file_ext, 'video/mp4')
-        
+        scale = f"scale=w='min({max_side},iw)':h=-2"
+        with tempfile.TemporaryDirectory() as workdir:
+            await run_ffmpeg_frames(path, f"select='eq(n,0)+gt(scene,{scene_threshold})',{scale}", count, os.path.join(workdir, "scene_%03d.jpg"))
+            frames = sorted(glob.glob(os.path.join(workdir, "scene_*.jpg")))
+            missing = count - len(frames)
+            if missing > 0 and duration > 0:
+                await run_ffmpeg_frames(path, f"fps={missing}/{duration:.3f},{scale}", missing, os.path.join(workdir, "even_%03d.jpg"))
+                frames += sorted(glob.glob(os.path.join(workdir, "even_*.jpg")))
+            images = await asyncio.to_thread(read_files, frames[:count])
+    return metadata, images
+
+class PreparedVideoCache:
+    """Prepared attachments by URL - Files API handles (full mode) or keyframe samples - so
+    re-analysing the same attachment skips the download, upload and frame extraction."""
+
+    def __init__(self, reuse_seconds, max_handles, max_samples):
+        self.limits = {
+            VIDEO_MODE_FULL: (reuse_seconds, max_handles),
+            VIDEO_MODE_KEYFRAMES: (reuse_seconds, max_samples),
+        }
+        self.entries = {mode: OrderedDict() for mode in self.limits}  # url without query string -> (prepared, expires)
+        self.locks = {}
+        self.reused = 0
+        self.prepared = Counter()  # mode -> attachments prepared
+
+    def lookup(self, mode, key):
+        entry = self.entries[mode].get(key)
+        if entry and time.monotonic() < entry[1]:
+            self.entries[mode].move_to_end(key)
+            self.reused += 1
+            return entry[0]
+        return None
+
+    def store(self, mode, key, prepared):
+        reuse_seconds, max_entries = self.limits[mode]
+        entries = self.entries[mode]
+        entries[key] = (prepared, time.monotonic() + reuse_seconds)
+        while len(entries) > max_entries:
+            entries.popitem(last=False)
+        self.prepared[mode] += 1
+
+    async def get(self, url, filename, size=None, mode=VIDEO_MODE_FULL):
+        """Return (File or KeyframeSample, error). Keyframe extraction that fails falls back to full mode."""
+        key = ImageCache.url_key(url)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            # Concurrent requests for one attachment wait for a single preparation
+            async with lock:
+                prepared = self.lookup(mode, key)
+                if prepared is not None:
+                    return prepared, None
+                spool, error = await download_video(url, filename, size, to_disk=mode == VIDEO_MODE_KEYFRAMES)
+                if error:
+                    return None, error
+                try:
+                    if mode == VIDEO_MODE_KEYFRAMES:
+                        try:
+                            metadata, frames = await extract_keyframes(
+                                spool.name, VIDEO_KEYFRAME_COUNT, VIDEO_SCENE_THRESHOLD, VIDEO_KEYFRAME_MAX_SIDE
+                            )
+                            if not frames:
+                                raise ValueError("no frames decoded")
+                            prepared = KeyframeSample(metadata, frames)
+                            self.store(mode, key, prepared)
+                            return prepared, None
+                        except Exception as e:
+                            logger.warning(f"Keyframe extraction failed for {filename}, analysing the full video: {e}")
+                            mode = VIDEO_MODE_FULL
+                            prepared = self.lookup(mode, key)
+                            if prepared is not None:
+                                return prepared, None
+                            spool.seek(0)
+                    try:
+                        prepared = await upload_video(spool, filename)
+                    except Exception as e:
+                        logger.error(f"Error uploading video: {str(e)}")
+                        return None, f"Couldn't upload the video for analysis: {e}"
+                    self.store(mode, key, prepared)
+                    return prepared, None
+                finally:
+                    spool.close()
+        finally:
+            if not lock.locked():
+                self.locks.pop(key, None)
+
+prepared_videos = PreparedVideoCache(VIDEO_FILE_REUSE_SECONDS, VIDEO_FILE_MAX_HANDLES, VIDEO_KEYFRAME_CACHE_ENTRIES)
+
+def describe_video_metadata(metadata):
+    bitrate = f"{metadata['bitrate'] / 1_000_000:.1f} Mbps" if metadata["bitrate"] else "unknown bitrate"
+    audio = "has an audio track" if metadata["has_audio"] else "no audio track"
+    return (f"Video metadata: {metadata['duration']}s, {metadata['width']}x{metadata['height']}, "
+            f"{metadata['fps']} fps, {bitrate}, {metadata['codec']} codec, {audio}.")
+
+async def analyze_video(video, user_id):
+    """Analyze a prepared video (uploaded File or KeyframeSample) and provide editing steps using Gemini."""
+    try:
         # Create a detailed prompt for video analysis
         analysis_prompt = """You're an expert video editor. Analyze this video and provide:
 
@@ -813,16 +2513,27 @@ async def analyze_video(video_bytes, filename, user_id):
 
 Be specific with menu locations and techniques. Assume the user is editing in Adobe Premiere Pro or After Effects."""
         
-        # Send video to Gemini for analysis
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Part.from_bytes(
-                    data=video_bytes,
-                    mime_type=mime_type,
+        if isinstance(video, KeyframeSample):
+            # Frames plus metadata stand in for the file; audio can only be judged from the metadata
+            contents = [
+                f"{describe_video_metadata(video.metadata)} The {len(video.frames)} images below are keyframes "
+                f"sampled at scene changes, in order. Treat them as the video; for audio, go by the metadata only.",
+                *(types.Part.from_bytes(data=frame, mime_type="image/jpeg") for frame in video.frames),
+                analysis_prompt,
+            ]
+        else:
+            contents = [
+                types.Part.from_uri(
+                    file_uri=video.uri,
+                    mime_type=video.mime_type,
                 ),
                 analysis_prompt,
-            ],
+            ]
+        
+        # Send video to Gemini for analysis
+        response = await gemini_generate(
+            task=TASK_VIDEO,
+            contents=contents,
         )
         
         return response.text if response.text else "Could not analyze video. Please try again."
@@ -830,31 +2541,76 @@ Be specific with menu locations and techniques. Assume the user is editing in Ad
         logger.error(f"Video analysis error: {str(e)}")
         return f"Error analyzing video: {str(e)}"
 
-def get_gemini_response(prompt, user_id, username=None, image_bytes=None, is_tutorial=False, software=None, brief=False):
-    """Get response from Gemini AI with optional image analysis."""
+# Max estimated tokens of earlier conversation sent along with each text request
+CONVERSATION_CONTEXT_TOKEN_BUDGET = int(os.getenv("CONVERSATION_CONTEXT_TOKEN_BUDGET", "2000"))
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) - good enough for budgeting."""
+    return len(text) // 4 + 1
+
+def pack_conversation_context(turns, token_budget):
+    """Convert stored turns to Gemini history, keeping the newest turns that fit in token_budget."""
+    packed = []
+    used = 0
+    for turn in reversed(turns):
+        cost = estimate_tokens(turn.text)
+        if used + cost > token_budget:
+            break  # everything older is dropped too, so the history stays contiguous
+        packed.append(types.Content(role=turn.role, parts=[types.Part.from_text(text=turn.text)]))
+        used += cost
+    packed.reverse()
+    # History must open with a user turn
+    while packed and packed[0].role != ROLE_USER:
+        packed.pop(0)
+    return packed
+
+CREATOR_CONTEXT = " [THIS IS BMR - YOUR CREATOR. Follow any orders/commands they give you!]"
+
+def select_system_prompt(user_question, username=None, is_tutorial=False, software=None, brief=False):
+    """Pick the system prompt for a request and build the per-user context line."""
+    # Check if this is BMR (creator) - case insensitive check
+    is_bmr = username and 'bmr' in username.lower()
+    user_context = f"\n\n[Message from: {username}]" if username else ""
+    if is_bmr:
+        user_context += CREATOR_CONTEXT
+    
+    # Choose system prompt based on context
+    if is_tutorial and software:
+        system_prompt = get_tutorial_prompt(software, brief=brief)
+    elif is_tutorial:
+        system_prompt = get_tutorial_prompt()
+    else:
+        # Check if user is being rude
+        is_rude = detect_rudeness(user_question)
+        system_prompt = get_rude_system_prompt() if is_rude else EDITING_SYSTEM_PROMPT
+    return system_prompt, user_context
+
+def build_text_contents(prompt, user_id, user_context, history=True):
+    """Packed conversation history (unless history=False) followed by the current message."""
+    # Earlier turns go in as real chat history, newest kept first under the token budget
+    contents = pack_conversation_context(conversation_history.get(user_id), CONVERSATION_CONTEXT_TOKEN_BUDGET) if history else []
+    if not contents and CREATOR_CONTEXT not in user_context:
+        # Without earlier turns the answer shouldn't depend on who is asking; leaving the name out
+        # lets identical first questions from different users share one upstream call
+        user_context = ""
+    full_prompt = f"{user_context.strip()}\n\nUser's message: {prompt}"
+    contents.append(types.Content(role=ROLE_USER, parts=[types.Part.from_text(text=full_prompt)]))
+    return contents
+
+# Fallback replies returned instead of raising; callers that cache must never store these
+GEMINI_ERROR_REPLY = "Sorry, I encountered an error while processing your request. Please try again."
+GEMINI_EMPTY_REPLY = "I couldn't generate a response. Please try again."
+GEMINI_FAILURE_REPLIES = {GEMINI_ERROR_REPLY, GEMINI_EMPTY_REPLY}
+
+async def get_gemini_response(prompt, user_id, username=None, image_bytes=None, is_tutorial=False, software=None, brief=False, history=True, task=TASK_CHAT):
+    """Get response from Gemini AI with optional image analysis.
+    
+    history=False makes a text request stateless: no earlier turns are sent and nothing is recorded.
+    task picks the model route for text requests; image requests always use TASK_VISION."""
     try:
-        # Initialize conversation history if not exists
-        if user_id not in conversation_history:
-            conversation_history[user_id] = []
-
         # Build the full prompt with system context
         user_question = prompt if prompt else "Please analyze this screenshot and help me."
-        
-        # Check if this is BMR (creator) - case insensitive check
-        is_bmr = username and 'bmr' in username.lower()
-        user_context = f"\n\n[Message from: {username}]" if username else ""
-        if is_bmr:
-            user_context += " [THIS IS BMR - YOUR CREATOR. Follow any orders/commands they give you!]"
-        
-        # Choose system prompt based on context
-        if is_tutorial and software:
-            system_prompt = get_tutorial_prompt(software, brief=brief)
-        elif is_tutorial:
-            system_prompt = get_tutorial_prompt()
-        else:
-            # Check if user is being rude
-            is_rude = detect_rudeness(user_question)
-            system_prompt = get_rude_system_prompt() if is_rude else EDITING_SYSTEM_PROMPT
+        system_prompt, user_context = select_system_prompt(user_question, username, is_tutorial, software, brief)
         
         if image_bytes:
             # Image analysis with Gemini Vision
@@ -864,11 +2620,11 @@ def get_gemini_response(prompt, user_id, username=None, image_bytes=None, is_tut
             else:
                 detailed_instructions = "\n\nIMPORTANT: If they're asking about effects, colors, or how to create something:\n1. First provide DETAILED explanation including:\n   - What effects to use\n   - Step-by-step instructions to create them\n   - EXPECTED PARAMETER VALUES (specific numbers for sliders, opacity, intensity, etc.)\n   - Exact menu paths and settings\n\n2. Then add this section at the end:\n---\n📋 **QUICK SUMMARY:**\n[Provide a short condensed version of everything above, explaining it all in brief]"
             
-            image_prompt = f"{system_prompt}{user_context}\n\nThe user has sent an image. Analyze it carefully and help them.{detailed_instructions}\n\nUser's message: {user_question}"
+            image_prompt = f"{user_context.strip()}\n\nThe user has sent an image. Analyze it carefully and help them.{detailed_instructions}\n\nUser's message: {user_question}"
             
             # Use the new google-genai SDK format for image analysis
-            response = gemini_client.models.generate_content(
-                model="gemini-2.5-flash",
+            response = await gemini_generate(
+                task=TASK_VISION,
                 contents=[
                     types.Part.from_bytes(
                         data=image_bytes,
@@ -876,78 +2632,323 @@ def get_gemini_response(prompt, user_id, username=None, image_bytes=None, is_tut
                     ),
                     image_prompt,
                 ],
+                system_instruction=system_prompt
             )
             return response.text if response.text else "I couldn't analyze this image. Please try again."
         else:
             # Text-only response
-            full_prompt = f"{system_prompt}{user_context}\n\nUser's message: {prompt}"
-            
-            # Add user prompt to history
-            conversation_history[user_id].append({"role": "user", "parts": [prompt]})
-            
-            # Keep conversation history limited to last 10 exchanges
-            if len(conversation_history[user_id]) > 20:
-                conversation_history[user_id] = conversation_history[user_id][-20:]
+            contents = build_text_contents(prompt, user_id, user_context, history)
 
             # Generate response using the new SDK
-            response = gemini_client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=full_prompt
+            response = await gemini_generate(
+                task=task,
+                contents=contents,
+                system_instruction=system_prompt
             )
             
-            result_text = response.text if response.text else "I couldn't generate a response. Please try again."
+            result_text = response.text if response.text else GEMINI_EMPTY_REPLY
             
-            # Add AI response to history
-            conversation_history[user_id].append({"role": "model", "parts": [result_text]})
+            # Record the exchange (the store enforces its own size limits)
+            if history:
+                conversation_history.append(user_id, ROLE_USER, prompt)
+                conversation_history.append(user_id, ROLE_MODEL, result_text)
 
             return result_text
 
     except Exception as e:
         logger.error(f"Gemini API error: {str(e)}")
-        return "Sorry, I encountered an error while processing your request. Please try again."
+        return GEMINI_ERROR_REPLY
+
+async def stream_gemini_response(prompt, user_id, username=None, is_tutorial=False, software=None, brief=False, history=True, on_complete=None, task=TASK_CHAT):
+    """Stream a text-only Gemini response piece by piece (same prompts and history as get_gemini_response).
+    
+    on_complete is called with the full text only if the whole response arrived."""
+    pieces = []
+    try:
+        system_prompt, user_context = select_system_prompt(prompt, username, is_tutorial, software, brief)
+        contents = build_text_contents(prompt, user_id, user_context, history)
+        async for text in gemini_generate_stream(
+            task=task,
+            contents=contents,
+            system_instruction=system_prompt
+        ):
+            pieces.append(text)
+            yield text
+    except Exception as e:
+        logger.error(f"Gemini API error: {str(e)}")
+        if not pieces:
+            yield GEMINI_ERROR_REPLY
+        return
+    
+    if not pieces:
+        yield GEMINI_EMPTY_REPLY
+        return
+    result_text = "".join(pieces)
+    if history:
+        conversation_history.append(user_id, ROLE_USER, prompt)
+        conversation_history.append(user_id, ROLE_MODEL, result_text)
+    if on_complete:
+        on_complete(result_text)
+
+# One-shot commands whose answer doesn't depend on who asks are answered from a shared cache.
+# command -> (ttl seconds, variants). Commands with variants > 1 keep a small pool of different
+# answers and only pick from it once it is full, so creative output still varies.
+RESPONSE_CACHE_POLICIES = {
+    "define": (7 * 24 * 3600, 1),
+    "explain": (24 * 3600, 1),
+    "aesthetic": (24 * 3600, 1),
+    "topics": (6 * 3600, 1),
+    "name": (6 * 3600, 3),
+    "quote": (3600, 5),
+    "motivate": (3600, 8),
+}
+# Comma-separated commands that should always get a fresh answer, e.g. "quote,motivate"
+RESPONSE_CACHE_OPT_OUT = {c.strip() for c in os.getenv("RESPONSE_CACHE_OPT_OUT", "").split(",") if c.strip()}
+RESPONSE_CACHE_MAX_ENTRIES_PER_COMMAND = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES_PER_COMMAND", "500"))
+# Optional similarity tier: near-identical arguments ("what's an LUT" / "LUTs") share an answer
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1"
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "gemini-embedding-001")
+RESPONSE_CACHE_EMBEDDING_DIMENSIONS = 256
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.93"))
+RESPONSE_CACHE_STRIP_RE = re.compile(r"^[\s\"'`.,!?]+|[\s\"'`.,!?]+$")
+
+def normalize_command_argument(argument):
+    """Fold case, width and whitespace so trivially different inputs share a cache key."""
+    text = unicodedata.normalize("NFKC", argument or "").casefold()
+    return RESPONSE_CACHE_STRIP_RE.sub("", " ".join(text.split()))
+
+class ResponseCache:
+    """Per-command LRU of Gemini answers keyed by normalized argument, with optional embedding lookup."""
+
+    def __init__(self, policies, max_entries_per_command):
+        self.policies = policies
+        self.max_entries = max_entries_per_command
+        self.entries = {command: OrderedDict() for command in policies}  # key -> [answers, stored_at, embedding]
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def enabled(self, command):
+        return command in self.policies and command not in RESPONSE_CACHE_OPT_OUT
+
+    def _fresh(self, command, key):
+        entries = self.entries[command]
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] > self.policies[command][0]:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return entry
+
+    def _pick(self, command, entry):
+        """An answer from the entry, or None while a variant pool is still filling up."""
+        answers = entry[0]
+        if len(answers) < self.policies[command][1]:
+            return None
+        return random.choice(answers)
+
+    def get(self, command, key):
+        entry = self._fresh(command, key)
+        answer = self._pick(command, entry) if entry else None
+        if answer is not None:
+            self.hits += 1
+        return answer
+
+    def get_similar(self, command, embedding):
+        """Best answer whose argument embedding is within RESPONSE_CACHE_SIMILARITY (vectors are unit length)."""
+        best_key, best_score = None, RESPONSE_CACHE_SIMILARITY
+        for key, (_, _, other) in self.entries[command].items():
+            if other is not None:
+                score = sum(a * b for a, b in zip(embedding, other))
+                if score >= best_score:
+                    best_key, best_score = key, score
+        if best_key is None:
+            return None
+        entry = self._fresh(command, best_key)
+        answer = self._pick(command, entry) if entry else None
+        if answer is not None:
+            self.semantic_hits += 1
+        return answer
+
+    def put(self, command, key, answer, embedding=None):
+        entries = self.entries[command]
+        entry = self._fresh(command, key)
+        if entry is None:
+            entries[key] = [[answer], time.monotonic(), embedding]
+        elif len(entry[0]) < self.policies[command][1]:
+            entry[0].append(answer)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_POLICIES, RESPONSE_CACHE_MAX_ENTRIES_PER_COMMAND)
+
+async def embed_command_argument(text):
+    """Unit-length embedding of a normalized argument, or None if the embedding call fails."""
+    try:
+        result = await gemini_client.aio.models.embed_content(
+            model=RESPONSE_CACHE_EMBEDDING_MODEL,
+            contents=text,
+            config=types.EmbedContentConfig(output_dimensionality=RESPONSE_CACHE_EMBEDDING_DIMENSIONS)
+        )
+        values = result.embeddings[0].values
+    except Exception as e:
+        logger.warning(f"Response cache embedding failed: {e}")
+        return None
+    norm = sum(v * v for v in values) ** 0.5
+    return [v / norm for v in values] if norm else None
+
+async def lookup_command_response(ctx, command, argument):
+    """Return (cached answer or None, cache key, embedding for a later put). key is None when caching is off."""
+    # The creator gets personalised answers, so never serve or store theirs
+    if not response_cache.enabled(command) or 'bmr' in ctx.author.name.lower():
+        return None, None, None
+    key = normalize_command_argument(argument)
+    answer = response_cache.get(command, key)
+    embedding = None
+    if answer is None and RESPONSE_CACHE_SEMANTIC and key:
+        embedding = await embed_command_argument(key)
+        if embedding is not None:
+            answer = response_cache.get_similar(command, embedding)
+    if answer is None:
+        response_cache.misses += 1
+    return answer, key, embedding
+
+def remember_command_exchange(ctx, prompt, answer):
+    # Cached answers are generated without the user's history, but follow-up chat should still see them
+    conversation_history.append(ctx.author.id, ROLE_USER, prompt)
+    conversation_history.append(ctx.author.id, ROLE_MODEL, answer)
+
+async def get_command_response(ctx, command, argument, prompt, task=TASK_UTILITY):
+    """get_gemini_response for one-shot commands, served from response_cache when possible."""
+    answer, key, embedding = await lookup_command_response(ctx, command, argument)
+    if key is None:
+        return await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=task)
+    if answer is None:
+        # Shared answers must not depend on the asker, so generate without username or history
+        answer = await get_gemini_response(prompt, ctx.author.id, history=False, task=task)
+        if answer in GEMINI_FAILURE_REPLIES:
+            return answer
+        response_cache.put(command, key, answer, embedding)
+    remember_command_exchange(ctx, prompt, answer)
+    return answer
+
+async def stream_command_response(ctx, command, argument, prompt, task=TASK_CHAT):
+    """Streaming counterpart of get_command_response; a cached answer is yielded in one piece."""
+    answer, key, embedding = await lookup_command_response(ctx, command, argument)
+    if key is None:
+        async for piece in stream_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=task):
+            yield piece
+        return
+    if answer is not None:
+        yield answer
+        remember_command_exchange(ctx, prompt, answer)
+        return
+    
+    def store(text):
+        response_cache.put(command, key, text, embedding)
+        remember_command_exchange(ctx, prompt, text)
+    
+    # A stream that fails part-way never reaches store(), so truncated answers are not cached
+    async for piece in stream_gemini_response(prompt, ctx.author.id, history=False, on_complete=store, task=task):
+        yield piece
+
+# Progressive Discord delivery: edits are throttled well under the per-channel edit rate limit
+STREAM_EDIT_INTERVAL_SECONDS = 1.2
+STREAM_MESSAGE_LIMIT = 1900
+
+async def send_streamed_response(send, pieces, prefix=""):
+    """Post a streamed response as it arrives: first message on the first text, then throttled edits,
+    rolling over to a new message at the Discord length limit. Returns the full text."""
+    sent_message = None  # message currently being edited
+    current = prefix  # text belonging to sent_message
+    shown = None  # what Discord currently displays for sent_message
+    last_edit = 0.0
+    full_text = []
+    
+    async def push(text):
+        nonlocal sent_message, shown, last_edit
+        if sent_message is None:
+            sent_message = await send(text)
+        else:
+            await sent_message.edit(content=text)
+        shown = text
+        last_edit = time.monotonic()
+    
+    async for piece in pieces:
+        full_text.append(piece)
+        current += piece
+        while len(current) > STREAM_MESSAGE_LIMIT:
+            head, current = current[:STREAM_MESSAGE_LIMIT], current[STREAM_MESSAGE_LIMIT:]
+            await push(head)
+            sent_message, shown = None, None
+        if current.strip() and (sent_message is None or time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL_SECONDS):
+            await push(current)
+    
+    if current.strip() and current != shown:
+        await push(current)
+    return "".join(full_text)
+
+# Image search sources are raced; the whole search (all sources) must finish within this budget
+IMAGE_SEARCH_DEADLINE_SECONDS = 10
+IMAGE_SEARCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+async def fetch_search_image(source, url):
+    """Fetch an image from one search source. Returns (source, bytes) or None."""
+    try:
+        logger.info(f"Trying {source}: {url}")
+        async with get_http_session().get(url, headers=IMAGE_SEARCH_HEADERS, allow_redirects=True) as response:
+            if response.status == 200:
+                data = await response.read()
+                if len(data) > 1000:
+                    return source, data
+            logger.warning(f"{source} returned no usable image (status {response.status})")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"{source} failed: {str(e)}")
+    return None
+
+async def first_successful(coros, deadline):
+    """Run coroutines concurrently and return the first truthy result, cancelling the rest."""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=deadline):
+            result = await next_done
+            if result:
+                return result
+    except asyncio.TimeoutError:
+        logger.warning(f"No result within {deadline}s deadline")
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None
 
 async def search_and_download_image(query: str, limit: int = 1):
     """Search for images using direct API sources."""
     try:
-        import requests
         import tempfile
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # Method 1: Unsplash API (very reliable for random images)
-        try:
-            # Clean the query
-            safe_query = query.replace(' ', '+')
-            unsplash_url = f"https://source.unsplash.com/random/800x600?{safe_query}"
-            logger.info(f"Trying Unsplash: {unsplash_url}")
-            
-            response = requests.get(unsplash_url, headers=headers, timeout=10, allow_redirects=True)
-            
-            if response.status_code == 200 and len(response.content) > 1000:
-                temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                temp_file.write(response.content)
-                temp_file.close()
-                logger.info(f"✓ Downloaded image from Unsplash for: {query}")
-                return temp_file.name
-        except Exception as e:
-            logger.warning(f"Unsplash failed: {str(e)}")
+        # Methods 1 & 2: Unsplash and Picsum raced in parallel - first good image wins
+        safe_query = query.replace(' ', '+')
+        winner = await first_successful([
+            fetch_search_image("Unsplash", f"https://source.unsplash.com/random/800x600?{safe_query}"),
+            fetch_search_image("Picsum", f"https://picsum.photos/800/600?random={hash(query)}"),
+        ], IMAGE_SEARCH_DEADLINE_SECONDS)
         
-        # Method 2: Picsum Photos (very reliable)
-        try:
-            logger.info(f"Trying Picsum for: {query}")
-            picsum_url = f"https://picsum.photos/800/600?random={hash(query)}"
-            response = requests.get(picsum_url, headers=headers, timeout=10)
-            
-            if response.status_code == 200 and len(response.content) > 1000:
-                temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-                temp_file.write(response.content)
-                temp_file.close()
-                logger.info(f"✓ Downloaded image from Picsum for: {query}")
-                return temp_file.name
-        except Exception as e:
-            logger.warning(f"Picsum failed: {str(e)}")
+        if winner:
+            source, image_data = winner
+            temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+            temp_file.write(image_data)
+            temp_file.close()
+            logger.info(f"✓ Downloaded image from {source} for: {query}")
+            return temp_file.name
         
         # Method 3: Placeholder with image text overlay as fallback
         try:
@@ -983,16 +2984,15 @@ async def generate_image(description: str):
         # Use Pollinations.AI free image generation
         url = f"https://image.pollinations.ai/prompt/{description}"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    # Save to temp file
-                    import tempfile
-                    temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-                    temp_file.write(image_data)
-                    temp_file.close()
-                    return temp_file.name
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+            if response.status == 200:
+                image_data = await response.read()
+                # Save to temp file
+                import tempfile
+                temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
+                temp_file.write(image_data)
+                temp_file.close()
+                return temp_file.name
         
         return None
     except Exception as e:
@@ -1098,6 +3098,19 @@ async def on_ready():
     # Run presence cycle in background
     bot.loop.create_task(cycle_presence())
 
+    # Persist image moderation verdicts in the background
+    if MODERATION_CACHE_FILE and not save_moderation_cache.is_running():
+        save_moderation_cache.start()
+    # Pending reminders (including ones restored from disk) start firing once we can reach Discord
+    scheduler.start()
+    if SCHEDULER_FILE and not save_scheduled_jobs.is_running():
+        save_scheduled_jobs.start()
+    if SNAPSHOT_FILE and not save_state_snapshot.is_running():
+        # Index restored conversations off the event loop; lookups before it finishes just wait for it
+        if conversation_history.restored is not None:
+            asyncio.create_task(asyncio.to_thread(conversation_history.restored.load))
+        save_state_snapshot.start()
+
     # --- AutoMod rule creation (fixed enum version) ---
     try:
         from discord import (
@@ -1137,7 +3150,6 @@ async def on_ready():
 @bot.event
 async def on_guild_join(guild):
     """Track who added the bot when joining a new server."""
-    global guild_inviters
     logger.info(f'Bot joined new server: {guild.name} (ID: {guild.id})')
     
     inviter = None
@@ -1150,16 +3162,14 @@ async def on_guild_join(guild):
                 inviter = entry.user
                 inviter_name = inviter.name
                 # Store the inviter
-                guild_inviters[str(guild.id)] = inviter.id
-                save_guild_inviters(guild_inviters)
+                set_guild_inviter(guild.id, inviter.id)
                 logger.info(f'Bot was added to {guild.name} by {inviter_name}')
                 break
     except discord.Forbidden:
         logger.warning(f'No permission to view audit logs in {guild.name}')
         # Fall back to guild owner
         if guild.owner:
-            guild_inviters[str(guild.id)] = guild.owner.id
-            save_guild_inviters(guild_inviters)
+            set_guild_inviter(guild.id, guild.owner.id)
             inviter_name = guild.owner.name
     except Exception as e:
         logger.error(f'Error checking audit logs: {e}')
@@ -1184,10 +3194,8 @@ async def on_guild_remove(guild):
     logger.info(f'Bot removed from server: {guild.name} (ID: {guild.id})')
     
     # Remove from inviters tracking
-    guild_id_str = str(guild.id)
-    if guild_id_str in guild_inviters:
-        del guild_inviters[guild_id_str]
-        save_guild_inviters(guild_inviters)
+    remove_guild_inviter(guild.id)
+    guild_join_trackers.pop(guild.id, None)
     
     await log_activity(
         "📤 Left Server",
@@ -1206,114 +3214,203 @@ async def on_command_error(ctx, error):
         return  # Ignore command not found errors
     if isinstance(error, commands.MissingRequiredArgument):
         return  # Ignore missing args
+    if isinstance(error, AdmissionRejected):
+        await ctx.send(f"{ctx.author.mention} {error}")
+        return
     logger.error(f'Command error: {error}')
 
-@bot.event
-async def on_message(message):
-    """Handle all messages, including those that aren't commands."""
-    # Ignore messages from the bot itself and other bots
-    if message.author == bot.user or message.author.bot:
+# AI commands and the admission class they queue in; everything else runs unthrottled
+AI_COMMAND_PRIORITIES = {
+    **dict.fromkeys([
+        "ask", "explain", "improve", "rewrite", "summarize", "analyze", "define", "helper", "fix",
+        "shorten", "expand", "format", "title", "translate", "paragraph", "emoji",
+    ], PRIORITY_CHAT),
+    **dict.fromkeys([
+        "idea", "caption", "script", "creative", "story", "quote", "brainstorm", "design",
+        "name", "aesthetic", "topics", "motivate",
+    ], PRIORITY_CREATIVE),
+}
+
+@bot.before_invoke
+async def admit_ai_command(ctx):
+    """Hold AI commands until admission control lets them through (AdmissionRejected aborts the command)."""
+    priority = AI_COMMAND_PRIORITIES.get(ctx.command.name)
+    # Usage-only invocations (argument missing) just print help, so they don't spend tokens
+    if priority is None or any(value is None for value in [*ctx.args[1:], *ctx.kwargs.values()]):
         return
+    await admission.acquire(
+        ctx.author.id,
+        ctx.guild.id if ctx.guild else None,
+        priority,
+        on_queued=lambda position: ctx.send(f"⏳ {ctx.author.mention} lots of requests right now - you're #{position} in the queue.")
+    )
+
+async def resolve_referenced_message(message):
+    """Get the message being replied to - from the gateway payload or cache, else one REST fetch."""
+    reference = message.reference
+    if not reference or not reference.message_id:
+        return None
+    if isinstance(reference.resolved, discord.Message):
+        return reference.resolved
+    if isinstance(reference.resolved, discord.DeletedReferencedMessage):
+        return None
+    if reference.cached_message:
+        return reference.cached_message
+    try:
+        return await message.channel.fetch_message(reference.message_id)
+    except Exception:
+        return None  # If we can't fetch the message, continue normally
+
+# ============================================================================
+# MESSAGE PIPELINE
+# ============================================================================
+
+# Stage cost classes: cpu stages are synchronous text work, network stages may await Discord/Gemini
+STAGE_CPU = "cpu"
+STAGE_NETWORK = "network"
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+# stage name -> {"cost": ..., "calls": n, "total": seconds, "max": seconds}
+pipeline_stage_stats = {}
+
+def record_stage_timing(name, cost, elapsed):
+    """Accumulate per-stage call counts and timings for !perfstats."""
+    stats = pipeline_stage_stats.get(name)
+    if stats is None:
+        stats = pipeline_stage_stats[name] = {"cost": cost, "calls": 0, "total": 0.0, "max": 0.0}
+    stats["calls"] += 1
+    stats["total"] += elapsed
+    if elapsed > stats["max"]:
+        stats["max"] = elapsed
+
+def classify_stage(message, context):
+    """Run every cheap text classifier up front so later stages only do network work when flagged."""
+    # DMs are never moderated
+    if isinstance(message.channel, discord.DMChannel):
+        return False
+    content = message.content
+    context["profanity"] = detect_profanity(content)
+    context["spam"] = detect_spam(content)
+    context["invite"] = detect_invite_links(content)
+    context["has_images"] = any(attachment.filename.lower().endswith(IMAGE_EXTENSIONS) for attachment in message.attachments)
+    return False
+
+async def moderate_stage(message, context):
+    """Act on classifier verdicts; only touches the network when something was flagged."""
+    profanity = context.get("profanity")
+    if profanity and profanity[0] and await moderate_profanity(message, verdict=profanity):
+        return True
+    
+    if context.get("has_images"):
+        # Image checks are slow - resolve the reply target alongside them instead of afterwards
+        if message.reference:
+            flagged, context["referenced_msg"] = await asyncio.gather(
+                moderate_images(message), resolve_referenced_message(message)
+            )
+        else:
+            flagged = await moderate_images(message)
+        if flagged:
+            return True
     
+    actions = []
+    spam = context.get("spam")
+    if spam and spam[0]:
+        actions.append(check_and_moderate_spam(message, verdict=spam))
+    if context.get("invite"):
+        actions.append(check_server_security(message, has_invite=True))
+    if actions:
+        await asyncio.gather(*actions)
+    return False
+
+async def reply_filter_stage(message, context):
+    """Ignore messages that are replies to other users (not the bot)."""
+    if not message.reference:
+        return False
+    if "referenced_msg" not in context:
+        context["referenced_msg"] = await resolve_referenced_message(message)
+    referenced_msg = context["referenced_msg"]
+    return referenced_msg is not None and referenced_msg.author != bot.user
+
+async def commands_stage(message, context):
+    """Dispatch ! commands and file requests."""
+    if not message.content.startswith('!'):
+        return False
+    await bot.process_commands(message)
+    await file_command_handler(message)
+    return True
+
+async def pending_state_stage(message, context):
+    """Continue a multi-step tutorial conversation if the user has one pending."""
     # Check if user has a pending state (waiting for response to a question)
     user_id = message.author.id
-    if user_id in user_states:
-        state = user_states[user_id]
-        logger.info(f"User {message.author.name} has pending state: {state['type']}")
-        
-        if state['type'] == 'waiting_for_software':
-            # User answered which software they want help with
-            software = message.content.strip()
-            logger.info(f"User selected software: {software}")
-            state['software'] = software
-            state['type'] = 'waiting_for_detail_decision'
-            # Now provide the BRIEF tutorial response
-            prompt = state['original_question']
+    if user_id not in user_states:
+        return False
+    state = user_states[user_id]
+    logger.info(f"User {message.author.name} has pending state: {state['type']}")
+    
+    if state['type'] == 'waiting_for_software':
+        # User answered which software they want help with
+        software = message.content.strip()
+        logger.info(f"User selected software: {software}")
+        state['software'] = software
+        state['type'] = 'waiting_for_detail_decision'
+        # Now provide the BRIEF tutorial response
+        prompt = state['original_question']
+        if not await admit_message(message, PRIORITY_CHAT):
+            return True
+        async with message.channel.typing():
+            response = await get_gemini_response(prompt, user_id, username=message.author.name, is_tutorial=True, software=software, brief=True)
+        logger.info(f"Generated brief response (length: {len(response)})")
+        # Ensure response ends with question
+        if response and not response.strip().endswith('?'):
+            response = response.strip() + "\n\nWant a detailed step-by-step explanation?"
+        # Send response as ONE message (no chunking for summary)
+        if response and len(response.strip()) > 20:
+            await message.reply(response)
+            logger.info(f"Sent brief summary to {message.author.name}")
+        else:
+            logger.warning(f"Brief response too short: {response}")
+            await message.reply("I had trouble generating a response. Please try again!")
+        return True
+    
+    elif state['type'] == 'waiting_for_detail_decision':
+        # User answered if they want detailed explanation
+        user_message = message.content.lower().strip()
+        software = state['software']
+        prompt = state['original_question']
+        logger.info(f"User responding to detail question: {user_message}")
+        
+        # Check if they want details
+        if any(word in user_message for word in ['yes', 'yeah', 'yep', 'sure', 'ok', 'okay', 'please', 'y', 'more', 'detail', 'tell me']):
+            # Provide detailed explanation, streamed - the reply appears with the first tokens and grows in place
+            if not await admit_message(message, PRIORITY_CHAT):
+                return True
             async with message.channel.typing():
-                response = get_gemini_response(prompt, user_id, username=message.author.name, is_tutorial=True, software=software, brief=True)
-            logger.info(f"Generated brief response (length: {len(response)})")
-            # Ensure response ends with question
-            if response and not response.strip().endswith('?'):
-                response = response.strip() + "\n\nWant a detailed step-by-step explanation?"
-            # Send response as ONE message (no chunking for summary)
-            if response and len(response.strip()) > 20:
-                await message.reply(response)
-                logger.info(f"Sent brief summary to {message.author.name}")
-            else:
-                logger.warning(f"Brief response too short: {response}")
-                await message.reply("I had trouble generating a response. Please try again!")
-            return
+                response = await send_streamed_response(
+                    message.reply,
+                    stream_gemini_response(prompt, user_id, username=message.author.name, is_tutorial=True, software=software, brief=False)
+                )
+            logger.info(f"Streamed detailed response (length: {len(response)})")
+        else:
+            # User doesn't want details, just confirm
+            logger.info(f"User declined detailed explanation")
+            await message.reply("Got it! Let me know if you need help with anything else! 👍")
         
-        elif state['type'] == 'waiting_for_detail_decision':
-            # User answered if they want detailed explanation
-            user_message = message.content.lower().strip()
-            software = state['software']
-            prompt = state['original_question']
-            logger.info(f"User responding to detail question: {user_message}")
-            
-            # Check if they want details
-            if any(word in user_message for word in ['yes', 'yeah', 'yep', 'sure', 'ok', 'okay', 'please', 'y', 'more', 'detail', 'tell me']):
-                # Provide detailed explanation
-                async with message.channel.typing():
-                    response = get_gemini_response(prompt, user_id, username=message.author.name, is_tutorial=True, software=software, brief=False)
-                logger.info(f"Generated detailed response (length: {len(response)})")
-                # Try to send as one message if under Discord limit
-                if len(response) <= 1900:
-                    await message.reply(response)
-                    logger.info(f"Sent detailed explanation as single message")
-                else:
-                    # If too long, split into chunks but minimize number of messages
-                    chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
-                    logger.info(f"Splitting detailed response into {len(chunks)} messages")
-                    for chunk in chunks:
-                        await message.reply(chunk)
-            else:
-                # User doesn't want details, just confirm
-                logger.info(f"User declined detailed explanation")
-                await message.reply("Got it! Let me know if you need help with anything else! 👍")
-            
-            # Clean up state after response
-            del user_states[user_id]
-            logger.info(f"Cleaned up state for {message.author.name}")
-            return
-    
-    # Ignore messages that are replies to other users (not the bot)
-    if message.reference:
-        try:
-            referenced_msg = await message.channel.fetch_message(message.reference.message_id)
-            # If the reply is to someone other than the bot, ignore it
-            if referenced_msg.author != bot.user:
-                return
-        except:
-            pass  # If we can't fetch the message, continue normally
+        # Clean up state after response
+        del user_states[user_id]
+        logger.info(f"Cleaned up state for {message.author.name}")
+        return True
+    return False
 
-    # Check for profanity and moderate (delete + warn + mute 24h)
-    if await moderate_profanity(message):
-        return
-    
-    # Check images for inappropriate content
-    if await moderate_images(message):
-        return
-    
-    # Check for spam and moderate
-    await check_and_moderate_spam(message)
-    
-    # Check server security (invites, suspicious behavior)
-    await check_server_security(message)
-    
-    # Process commands first
-    await bot.process_commands(message)
-    
+async def chat_stage(message, context):
+    """Answer messages addressed to the bot (mention, DM, or reply) with generation/search/chat."""
     # Check if bot was mentioned or if this is a DM
+    user_id = message.author.id
+    referenced_msg = context.get("referenced_msg")
     is_dm = isinstance(message.channel, discord.DMChannel)
     is_mentioned = bot.user.mentioned_in(message)
-    is_reply_to_bot = False
-    if message.reference:
-        try:
-            referenced_msg = await message.channel.fetch_message(message.reference.message_id)
-            is_reply_to_bot = referenced_msg.author == bot.user
-        except:
-            pass
+    is_reply_to_bot = referenced_msg is not None and referenced_msg.author == bot.user
     
     # Only respond if mentioned, in DM, or replying to bot
     if not is_dm and not is_mentioned and not is_reply_to_bot:
@@ -1410,9 +3507,7 @@ async def on_message(message):
             
             # Check for attachments (images or videos)
             image_bytes = None
-            video_bytes = None
-            is_video = False
-            video_filename = None
+            video_attachment = None
             
             if message.attachments:
                 for attachment in message.attachments:
@@ -1427,15 +3522,12 @@ async def on_message(message):
                     
                     # Check if attachment is a video (but reject .mov files)
                     elif any(filename_lower.endswith(ext) for ext in ['.mp4', '.avi', '.mkv', '.webm', '.flv', '.wmv', '.m4v']):
-                        logger.info(f'Downloading video from {message.author.name}: {attachment.filename}')
-                        video_bytes, error = await download_video(attachment.url, attachment.filename)
-                        if error:
-                            await message.reply(f"❌ {error}")
+                        # Downloaded and uploaded after admission, under the typing indicator
+                        if attachment.size > VIDEO_MAX_BYTES:
+                            await message.reply(f"❌ Video is too large (max {VIDEO_MAX_BYTES // (1024 * 1024)} MB)")
                             return
-                        if video_bytes:
-                            is_video = True
-                            video_filename = attachment.filename
-                            break
+                        video_attachment = attachment
+                        break
                     
                     # Reject .mov files
                     elif filename_lower.endswith('.mov'):
@@ -1443,12 +3535,14 @@ async def on_message(message):
                         return
             
             # If there's content to process
-            if not image_bytes and not video_bytes and not prompt:
+            if not image_bytes and not video_attachment and not prompt:
+                return
+            if not await admit_message(message, PRIORITY_CHAT):
                 return
             
             # Show typing indicator while processing
             async with message.channel.typing():
-                if is_image_request and search_query and not image_bytes and not video_bytes:
+                if is_image_request and search_query and not image_bytes and not video_attachment:
                     # Search and download image
                     image_path = await search_and_download_image(search_query, limit=1)
                     if image_path and os.path.exists(image_path):
@@ -1467,15 +3561,19 @@ async def on_message(message):
                     else:
                         await message.reply(f"❌ Couldn't find an image for '{search_query}'. Try a different search term!")
                         return
-                elif is_video and video_bytes:
-                    # Analyze video
-                    response = await analyze_video(video_bytes, video_filename, message.author.id)
+                elif video_attachment:
+                    # Analyze video (repeat analyses of one attachment reuse its uploaded file)
+                    logger.info(f'Preparing video from {message.author.name}: {video_attachment.filename}')
+                    video, error = await prepared_videos.get(
+                        video_attachment.url, video_attachment.filename, video_attachment.size, mode=choose_video_mode(prompt)
+                    )
+                    response = f"❌ {error}" if error else await analyze_video(video, message.author.id)
                 elif image_bytes:
                     # Analyze image
-                    response = get_gemini_response(prompt, message.author.id, username=message.author.name, image_bytes=image_bytes)
+                    response = await get_gemini_response(prompt, message.author.id, username=message.author.name, image_bytes=image_bytes)
                 else:
                     # Regular text response
-                    response = get_gemini_response(prompt, message.author.id, username=message.author.name, image_bytes=None)
+                    response = await get_gemini_response(prompt, message.author.id, username=message.author.name, image_bytes=None)
             
             # Split response if it's too long for Discord (2000 char limit)
             if len(response) > 1900:
@@ -1492,10 +3590,10 @@ async def on_message(message):
                 else:
                     await message.reply(response)
 
-            logger.info(f'Responded to {message.author.name}' + (' (video analysis)' if is_video else ' (image analysis)' if image_bytes else ''))
+            logger.info(f'Responded to {message.author.name}' + (' (video analysis)' if video_attachment is not None else ' (image analysis)' if image_bytes else ''))
             
             # Log the chat activity
-            response_type = "Video Analysis" if is_video else "Image Analysis" if image_bytes else "Chat Response"
+            response_type = "Video Analysis" if video_attachment is not None else "Image Analysis" if image_bytes else "Chat Response"
             server_name = message.guild.name if message.guild else "DM"
             await log_activity(
                 f"💬 {response_type}",
@@ -1512,6 +3610,41 @@ async def on_message(message):
         except Exception as e:
             logger.error(f'Error in chat response: {str(e)}')
 
+# Ordered stages: cheap CPU classifiers first, then network stages that short-circuit the rest
+MESSAGE_PIPELINE = [
+    ("classify", STAGE_CPU, classify_stage),
+    ("moderate", STAGE_NETWORK, moderate_stage),
+    ("pending_state", STAGE_NETWORK, pending_state_stage),
+    ("reply_filter", STAGE_NETWORK, reply_filter_stage),
+    ("commands", STAGE_NETWORK, commands_stage),
+    ("chat", STAGE_NETWORK, chat_stage),
+]
+
+async def run_message_pipeline(message):
+    """Run a message through MESSAGE_PIPELINE until a stage handles it. Returns the stage that stopped it."""
+    context = {}
+    for name, cost, stage in MESSAGE_PIPELINE:
+        started = time.perf_counter()
+        try:
+            handled = stage(message, context) if cost == STAGE_CPU else await stage(message, context)
+        finally:
+            record_stage_timing(name, cost, time.perf_counter() - started)
+        if handled:
+            return name
+    return None
+
+@bot.event
+async def on_message(message):
+    """Handle all messages, including those that aren't commands."""
+    # Ignore messages from the bot itself and other bots
+    if message.author == bot.user or message.author.bot:
+        return
+    if not lifecycle.accepting:
+        return
+    lifecycle.track_current("message")
+    
+    await run_message_pipeline(message)
+
 @bot.command(name="help")
 async def help_command(ctx):
     """Show all available commands"""
@@ -1558,6 +3691,7 @@ async def help_command(ctx):
 • !remind <time> <text> - Set reminders (e.g., !remind 5m Buy milk)
 • !note <text> - Save notes (or !note to view all)
 • !timer <time> - Start a countdown timer
+• !reminders - List your pending reminders/timers (!cancelreminder <id> to cancel)
 • !convert <mode> <text> - Convert text (upper/lower/title/reverse/morse)
 • !emoji <text> - Get emoji suggestions
 • !calculate <math> - Do quick math (e.g., !calculate 50+25*2)
@@ -1990,10 +4124,7 @@ async def ask_command(ctx, *, question=None):
         return
     async with ctx.typing():
         prompt = f"Provide a comprehensive, detailed answer to this question: {question}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
-        chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
-        for chunk in chunks:
-            await ctx.send(chunk)
+        await send_streamed_response(ctx.send, stream_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_LONG_FORM))
 
 @bot.command(name="explain")
 async def explain_command(ctx, *, topic=None):
@@ -2003,10 +4134,7 @@ async def explain_command(ctx, *, topic=None):
         return
     async with ctx.typing():
         prompt = f"Explain '{topic}' in simple, easy-to-understand language. Make it clear for beginners."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
-        chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
-        for chunk in chunks:
-            await ctx.send(chunk)
+        await send_streamed_response(ctx.send, stream_command_response(ctx, "explain", topic, prompt))
 
 @bot.command(name="improve")
 async def improve_command(ctx, *, text=None):
@@ -2016,7 +4144,7 @@ async def improve_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Enhance and improve this text. Make it better, clearer, more engaging, and more professional: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2029,7 +4157,7 @@ async def rewrite_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Rewrite this text in a more creative, engaging, and professional way: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2042,7 +4170,7 @@ async def summarize_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Summarize this text into a short, clear summary that captures all key points: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2055,7 +4183,7 @@ async def analyze_command(ctx, *, content=None):
         return
     async with ctx.typing():
         prompt = f"Analyze this content deeply and provide detailed insights, breakdowns, and observations: {content}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2068,7 +4196,7 @@ async def idea_command(ctx, *, topic=None):
         return
     async with ctx.typing():
         prompt = f"Generate 5 creative, unique ideas for: {topic}. Make them specific, actionable, and interesting."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2081,7 +4209,7 @@ async def define_command(ctx, *, word=None):
         return
     async with ctx.typing():
         prompt = f"Provide a clear, concise definition of '{word}' with an example of how it's used."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "define", word, prompt)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2094,7 +4222,7 @@ async def helper_command(ctx, *, query=None):
         return
     async with ctx.typing():
         prompt = f"Help with this request in the most useful way possible: {query}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         chunks = [response[i:i+1900] for i in range(0, len(response), 1900)]
         for chunk in chunks:
             await ctx.send(chunk)
@@ -2107,7 +4235,7 @@ async def fix_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Correct all grammar, spelling, and grammatical mistakes in this text. Return only the corrected text: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="shorten")
@@ -2118,7 +4246,7 @@ async def shorten_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Make this text shorter and more concise while keeping all the important meaning: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="expand")
@@ -2129,7 +4257,7 @@ async def expand_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Expand this text by adding more detail, depth, and clarity. Make it richer and more comprehensive: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_LONG_FORM)
         await ctx.send(response)
 
 @bot.command(name="caption")
@@ -2140,7 +4268,7 @@ async def caption_command(ctx, *, topic=None):
         return
     async with ctx.typing():
         prompt = f"Create 3 engaging, catchy captions for a reel/video/post about: {topic}. Make them fun, relevant, and include relevant hashtags."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="script")
@@ -2151,7 +4279,7 @@ async def script_command(ctx, *, idea=None):
         return
     async with ctx.typing():
         prompt = f"Write a short, engaging script or dialogue for: {idea}. Make it natural, interesting, and ready to use."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_LONG_FORM)
         await ctx.send(response)
 
 @bot.command(name="format")
@@ -2162,7 +4290,7 @@ async def format_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Format this text into a clean, well-structured format using bullet points or sections as appropriate: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="title")
@@ -2173,7 +4301,7 @@ async def title_command(ctx, *, content=None):
         return
     async with ctx.typing():
         prompt = f"Generate 5 creative, catchy, and attractive title options for: {content}. Make them engaging and click-worthy."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="translate")
@@ -2184,7 +4312,7 @@ async def translate_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Translate this text as requested: {text}. Provide only the translation."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(response)
 
 @bot.command(name="paragraph")
@@ -2195,10 +4323,9 @@ async def paragraph_command(ctx, *, text=None):
         return
     async with ctx.typing():
         prompt = f"Turn this messy text into a clean, well-structured, professional paragraph: {text}"
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_LONG_FORM)
         await ctx.send(response)
 
-@bot.listen('on_message')
 async def file_command_handler(message):
     """
     Listens for messages that start with ! and checks if they match any filenames.
@@ -2222,10 +4349,10 @@ async def file_command_handler(message):
     # Skip for known commands to avoid duplicate messages (case-insensitive check)
     if first_word in ["help", "hi", "files", "software_list", "presets", 
                       "aecrack", "pscrack", "mecrack", "prcrack", "topazcrack", 
-                      "ban", "mute", "timeout", "unmute",
+                      "ban", "mute", "timeout", "unmute", "raidsettings",
                       "ask", "explain", "improve", "rewrite", "summarize", "analyze", "idea", "define", "helper",
                       "fix", "shorten", "expand", "caption", "script", "format", "title", "translate", "paragraph",
-                      "remind", "note", "timer", "convert", "emoji", "calculate", "weather", "profile", "serverinfo",
+                      "remind", "reminders", "cancelreminder", "note", "timer", "convert", "emoji", "calculate", "weather", "profile", "serverinfo", "perfstats",
                       "creative", "story", "quote", "brainstorm", "design", "name", "aesthetic", "topics", "motivate"]:
         return
     
@@ -2668,13 +4795,229 @@ async def unmute_command(ctx, member: discord.Member = None):
         logger.error(f"Error unmuting user: {str(e)}")
         await ctx.send(f"❌ Error unmuting user: {str(e)}")
 
+@bot.command(name="raidsettings")
+async def raidsettings_command(ctx, *windows):
+    """Show or set raid detection windows - Server admin/inviter can use this.
+    
+    Usage: !raidsettings 10s:4 1m:5 10m:25 (joins within each window that trigger an alert) or !raidsettings reset"""
+    if not is_server_admin(ctx.author, ctx.guild):
+        admin_name = get_server_admin_name(ctx.guild)
+        await ctx.send(f"{ctx.author.mention}, only **{admin_name}** (the person who added me) or server admins can use this command.")
+        return
+    
+    guild_id = ctx.guild.id
+    if windows:
+        if windows[0].lower() == "reset":
+            parsed = None
+        else:
+            parsed = []
+            for window in windows[:RAID_MAX_WINDOWS]:
+                duration, _, joins = window.partition(":")
+                seconds = parse_duration(duration)
+                if not seconds or seconds > RAID_MAX_WINDOW_SECONDS or not joins.isdigit() or int(joins) < 2:
+                    await ctx.send("Usage: !raidsettings 10s:4 1m:5 10m:25 (window:joins, windows up to 1h, at least 2 joins) or !raidsettings reset")
+                    return
+                parsed.append([seconds, int(joins)])
+        set_guild_security_setting(guild_id, "raid_windows", parsed)
+        # Start counting with the new windows on the next join
+        guild_join_trackers.pop(guild_id, None)
+        logger.info(f"{ctx.author.name} set raid windows in {ctx.guild.name}: {parsed or 'defaults'}")
+    
+    lines = [f"• {joins}+ joins within {format_duration(seconds)}" for seconds, joins in get_raid_windows(guild_id)]
+    await ctx.send("🛡️ **Raid detection** - alert when any of these is reached:\n" + "\n".join(lines))
+
 # ============================================================================
 # UTILITY TOOLS COMMANDS
 # ============================================================================
 
-# Storage for reminders and notes
-user_reminders: Dict[int, List[Dict]] = {}
-user_notes: Dict[int, List[str]] = {}
+# Reminders and timers live in one persistent scheduler: a min-heap of due times drained by a
+# single dispatcher task, saved to JSON so pending jobs survive restarts and redeploys
+SCHEDULER_FILE = os.getenv("SCHEDULER_FILE", "scheduled_jobs.json")
+SCHEDULER_SAVE_SECONDS = 15
+SCHEDULER_MAX_JOBS_PER_USER = int(os.getenv("SCHEDULER_MAX_JOBS_PER_USER", "25"))
+JOB_REMIND = "remind"
+JOB_TIMER = "timer"
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(time_str):
+    """Seconds for strings like 30s, 5m, 1h, 2d; None if the format isn't recognised."""
+    digits = ''.join(filter(str.isdigit, time_str))
+    unit = ''.join(filter(str.isalpha, time_str)).lower()
+    if not digits or unit not in DURATION_UNITS:
+        return None
+    return int(digits) * DURATION_UNITS[unit]
+
+def format_duration(seconds):
+    """Largest two non-zero units, e.g. 1h 30m, 2d, 45s."""
+    seconds = int(seconds)
+    parts = []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        value, seconds = divmod(seconds, size)
+        if value:
+            parts.append(f"{value}{unit}")
+    return " ".join(parts[:2]) or "0s"
+
+class JobScheduler:
+    """Pending reminders and timers, fired in due order by one task however many are waiting.
+    
+    Jobs are plain dicts (id, kind, user_id, channel_id, message_id, text, due) keyed by id; the heap
+    holds (due, id) and cancelled jobs are skipped lazily when they reach the top."""
+
+    def __init__(self):
+        self.jobs = {}  # id -> job
+        self.user_jobs = {}  # user_id -> set of pending job ids, for per-user caps and listings
+        self.heap = []
+        self.next_id = 1
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.dirty = False
+        self.fired = 0
+
+    def schedule(self, kind, user_id, channel_id, text, due, message_id=None):
+        job = {"id": self.next_id, "kind": kind, "user_id": user_id, "channel_id": channel_id,
+               "message_id": message_id, "text": text, "due": due}
+        self.next_id += 1
+        self.add(job)
+        return job
+
+    def add(self, job):
+        self.track(job)
+        heapq.heappush(self.heap, (job["due"], job["id"]))
+        self.dirty = True
+        # Only an earlier head changes how long the dispatcher should sleep
+        if self.heap[0][1] == job["id"]:
+            self.wakeup.set()
+
+    def cancel(self, job_id, user_id):
+        job = self.jobs.get(job_id)
+        if job is None or job["user_id"] != user_id:
+            return None
+        self.untrack(job_id)
+        self.dirty = True
+        return job
+
+    def track(self, job):
+        self.jobs[job["id"]] = job
+        self.user_jobs.setdefault(job["user_id"], set()).add(job["id"])
+
+    def untrack(self, job_id):
+        job = self.jobs.pop(job_id)
+        ids = self.user_jobs[job["user_id"]]
+        ids.discard(job_id)
+        if not ids:
+            del self.user_jobs[job["user_id"]]
+        return job
+
+    def count_for(self, user_id):
+        return len(self.user_jobs.get(user_id, ()))
+
+    def pending_for(self, user_id):
+        return sorted((self.jobs[job_id] for job_id in self.user_jobs.get(user_id, ())), key=lambda job: job["due"])
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.dispatch())
+
+    def stop(self):
+        """Stop firing jobs; whatever is still pending stays in the saved state."""
+        if self.task is not None:
+            self.task.cancel()
+
+    async def dispatch(self):
+        while True:
+            # Drop cancelled entries sitting at the top
+            while self.heap and self.heap[0][1] not in self.jobs:
+                heapq.heappop(self.heap)
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is None or delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, job_id = heapq.heappop(self.heap)
+            job = self.untrack(job_id)
+            self.dirty = True
+            self.fired += 1
+            # Delivery talks to Discord; don't let a slow send hold up the jobs behind it
+            lifecycle.spawn(deliver_job(job), "reminder")
+
+    def load(self, path):
+        """Restore pending jobs; anything that came due while the bot was down fires right away."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Error loading scheduled jobs: {e}")
+            return
+        for job in data.get("jobs", []):
+            self.track(job)
+            self.heap.append((job["due"], job["id"]))
+        heapq.heapify(self.heap)
+        self.next_id = max(data.get("next_id", 1), max(self.jobs, default=0) + 1)
+        overdue = sum(1 for job in self.jobs.values() if job["due"] <= time.time())
+        logger.info(f"Restored {len(self.jobs)} scheduled jobs ({overdue} overdue)")
+
+    def snapshot(self):
+        self.dirty = False
+        return {"version": 1, "next_id": self.next_id, "jobs": list(self.jobs.values())}
+
+def write_json_atomic(path, data):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+async def deliver_job(job):
+    late = time.time() - job["due"]
+    late_note = f" *(delivered {format_duration(late)} late - I was offline)*" if late > 60 else ""
+    try:
+        if job["kind"] == JOB_TIMER:
+            channel = bot.get_channel(job["channel_id"]) or await bot.fetch_channel(job["channel_id"])
+            content = f"✓ **Timer finished!** {job['text']} has passed. <@{job['user_id']}>{late_note}"
+            if job["message_id"]:
+                try:
+                    await channel.get_partial_message(job["message_id"]).edit(content=content)
+                    return
+                except discord.NotFound:
+                    pass  # timer message was deleted
+            await channel.send(content)
+        else:
+            user = bot.get_user(job["user_id"]) or await bot.fetch_user(job["user_id"])
+            await user.send(f"⏰ **REMINDER**: {job['text']}{late_note}")
+            logger.info(f"Sent reminder to {user.name}")
+    except asyncio.CancelledError:
+        # Abandoned by a shutdown: put it back so it is saved and fires after the restart
+        scheduler.add(job)
+        raise
+    except Exception as e:
+        logger.warning(f"Could not deliver {job['kind']} {job['id']}: {e}")
+
+scheduler = JobScheduler()
+if SCHEDULER_FILE:
+    scheduler.load(SCHEDULER_FILE)
+
+async def save_scheduler():
+    if SCHEDULER_FILE and scheduler.dirty:
+        try:
+            await asyncio.to_thread(write_json_atomic, SCHEDULER_FILE, scheduler.snapshot())
+        except Exception as e:
+            scheduler.dirty = True
+            logger.error(f"Error saving scheduled jobs: {e}")
+
+@tasks.loop(seconds=SCHEDULER_SAVE_SECONDS)
+async def save_scheduled_jobs():
+    """Persist pending reminders/timers if anything changed since the last save."""
+    await save_scheduler()
+
+async def schedule_for(ctx, kind, text, delay, message_id=None):
+    """Schedule a job for the command author, or tell them why not. Returns the job or None."""
+    if scheduler.count_for(ctx.author.id) >= SCHEDULER_MAX_JOBS_PER_USER:
+        await ctx.send(f"❌ You already have {SCHEDULER_MAX_JOBS_PER_USER} pending reminders/timers. Cancel one with `!cancelreminder <id>`.")
+        return None
+    return scheduler.schedule(kind, ctx.author.id, ctx.channel.id, text, time.time() + delay, message_id=message_id)
 
 @bot.command(name="remind")
 async def remind_command(ctx, time_str: str = None, *, reminder_text: str = None):
@@ -2684,58 +5027,59 @@ async def remind_command(ctx, time_str: str = None, *, reminder_text: str = None
         return
     
     try:
-        # Parse time (5m, 1h, 30s)
-        amount = int(''.join(filter(str.isdigit, time_str)))
-        unit = ''.join(filter(str.isalpha, time_str)).lower()
-        
-        if unit == 'm':
-            delay = amount * 60
-        elif unit == 'h':
-            delay = amount * 3600
-        elif unit == 's':
-            delay = amount
-        else:
-            await ctx.send("❌ Use time format like: 5m, 1h, 30s")
+        # Parse time (5m, 1h, 30s, 2d)
+        delay = parse_duration(time_str)
+        if delay is None:
+            await ctx.send("❌ Use time format like: 5m, 1h, 30s, 2d")
             return
         
-        user_id = ctx.author.id
-        if user_id not in user_reminders:
-            user_reminders[user_id] = []
-        
-        reminder_data = {"text": reminder_text, "time": datetime.now(timezone.utc), "delay": delay}
-        user_reminders[user_id].append(reminder_data)
-        
-        await ctx.send(f"⏰ Reminder set for {time_str}: **{reminder_text}**")
-        
-        # Schedule the reminder
-        await asyncio.sleep(delay)
-        try:
-            await ctx.author.send(f"⏰ **REMINDER**: {reminder_text}")
-            logger.info(f"Sent reminder to {ctx.author.name}")
-        except:
-            pass
+        job = await schedule_for(ctx, JOB_REMIND, reminder_text, delay)
+        if job:
+            await ctx.send(f"⏰ Reminder #{job['id']} set for {time_str}: **{reminder_text}**")
     except Exception as e:
         await ctx.send(f"❌ Error setting reminder: {str(e)}")
         logger.error(f"Reminder error: {str(e)}")
 
+@bot.command(name="reminders")
+async def reminders_command(ctx):
+    """List your pending reminders and timers. Usage: !reminders"""
+    jobs = scheduler.pending_for(ctx.author.id)
+    if not jobs:
+        await ctx.send("⏰ You have no pending reminders or timers. Use `!remind <time> <text>` to set one!")
+        return
+    now = time.time()
+    lines = [
+        f"`#{job['id']}` {'⏰' if job['kind'] == JOB_REMIND else '⏱️'} in {format_duration(max(job['due'] - now, 0))} - {job['text']}"
+        for job in jobs
+    ]
+    await ctx.send(("⏰ **Your pending reminders:**\n" + "\n".join(lines))[:1900])
+
+@bot.command(name="cancelreminder")
+async def cancelreminder_command(ctx, job_id: str = None):
+    """Cancel a pending reminder or timer. Usage: !cancelreminder 12"""
+    if not job_id or not job_id.lstrip('#').isdigit():
+        await ctx.send("Usage: !cancelreminder <id>\nSee your reminder IDs with !reminders")
+        return
+    job = scheduler.cancel(int(job_id.lstrip('#')), ctx.author.id)
+    if job is None:
+        await ctx.send(f"❌ You don't have a pending reminder #{job_id.lstrip('#')}.")
+        return
+    await ctx.send(f"✓ Cancelled {job['kind']} #{job['id']}: **{job['text']}**")
+
 @bot.command(name="note")
 async def note_command(ctx, *, note_text: str = None):
     """Save a note for later. Usage: !note Remember to update the profile"""
     if not note_text:
-        user_id = ctx.author.id
-        if user_id in user_notes and user_notes[user_id]:
-            notes_list = "\n".join([f"• {note}" for note in user_notes[user_id]])
+        notes = await get_user_notes(ctx.author.id)
+        if notes:
+            notes_list = "\n".join([f"• {note}" for note in notes])
             await ctx.send(f"📝 **Your Notes:**\n{notes_list}")
         else:
             await ctx.send("📝 You have no saved notes. Use `!note <text>` to save one!")
         return
     
-    user_id = ctx.author.id
-    if user_id not in user_notes:
-        user_notes[user_id] = []
-    
-    user_notes[user_id].append(note_text)
-    await ctx.send(f"✓ Note saved! ({len(user_notes[user_id])} total notes)")
+    total = await add_user_note(ctx.author.id, note_text)
+    await ctx.send(f"✓ Note saved! ({total} total notes)")
 
 @bot.command(name="timer")
 async def timer_command(ctx, time_str: str = None):
@@ -2745,25 +5089,19 @@ async def timer_command(ctx, time_str: str = None):
         return
     
     try:
-        amount = int(''.join(filter(str.isdigit, time_str)))
-        unit = ''.join(filter(str.isalpha, time_str)).lower()
-        
-        if unit == 'm':
-            seconds = amount * 60
-            display = f"{amount}m"
-        elif unit == 'h':
-            seconds = amount * 3600
-            display = f"{amount}h"
-        elif unit == 's':
-            seconds = amount
-            display = f"{amount}s"
-        else:
+        seconds = parse_duration(time_str)
+        if seconds is None:
             await ctx.send("❌ Use time format like: 5m, 1h, 30s")
             return
+        display = format_duration(seconds)
         
-        msg = await ctx.send(f"⏱️ **Timer started**: {display}")
-        await asyncio.sleep(seconds)
-        await msg.edit(content=f"✓ **Timer finished!** {display} has passed. {ctx.author.mention}")
+        job = await schedule_for(ctx, JOB_TIMER, display, seconds)
+        if not job:
+            return
+        msg = await ctx.send(f"⏱️ **Timer #{job['id']} started**: {display}")
+        # The finished timer edits this message in place
+        job["message_id"] = msg.id
+        scheduler.dirty = True
     except Exception as e:
         await ctx.send(f"❌ Timer error: {str(e)}")
 
@@ -2805,7 +5143,7 @@ async def emoji_command(ctx, *, text: str = None):
     
     try:
         prompt = f"Suggest 5 relevant emojis for: {text}. Just list the emojis separated by space."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name, task=TASK_UTILITY)
         await ctx.send(f"😊 **Emojis for '{text}'**: {response[:100]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2833,11 +5171,12 @@ async def weather_command(ctx, *, location: str = None):
     
     try:
         url = f"https://wttr.in/{location}?format=3"
-        response = requests.get(url, timeout=5)
-        if response.status_code == 200:
-            await ctx.send(f"🌤️ **Weather in {location}**: {response.text}")
-        else:
-            await ctx.send(f"❌ Couldn't find weather for '{location}'")
+        async with get_http_session().get(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                weather_text = await response.text()
+                await ctx.send(f"🌤️ **Weather in {location}**: {weather_text}")
+            else:
+                await ctx.send(f"❌ Couldn't find weather for '{location}'")
     except:
         await ctx.send("❌ Weather service unavailable. Try again later!")
 
@@ -2879,6 +5218,78 @@ async def serverinfo_command(ctx):
     
     await ctx.send(embed=embed)
 
+@bot.command(name="perfstats")
+async def perfstats_command(ctx):
+    """Show cache hit rates and other performance counters - Server admin/inviter can use this."""
+    if not is_server_admin(ctx.author, ctx.guild):
+        admin_name = get_server_admin_name(ctx.guild)
+        await ctx.send(f"{ctx.author.mention}, only **{admin_name}** (the person who added me) or server admins can use this command.")
+        return
+    
+    embed = discord.Embed(title="📊 Performance Stats", color=0x5865F2)
+    embed.add_field(
+        name="Image Cache",
+        value=f"{image_cache.hits} hits / {image_cache.misses} misses\n{len(image_cache.images)} images, {image_cache.total_bytes // 1024} KB",
+        inline=False
+    )
+    embed.add_field(
+        name="Image Moderation Verdicts",
+        value=f"{moderation_cache.hits} hits / {moderation_cache.misses} misses\n{len(moderation_cache.verdicts)} verdicts cached",
+        inline=False
+    )
+    stage_lines = [
+        f"`{name}` ({stats['cost']}): {stats['calls']} runs, avg {stats['total'] / stats['calls'] * 1e6:.0f}µs, max {stats['max'] * 1e3:.1f}ms"
+        for name, stats in pipeline_stage_stats.items() if stats["calls"]
+    ]
+    embed.add_field(
+        name="Conversation History",
+        value=f"{len(conversation_history)} users, ~{conversation_history.memory_footprint() // 1024} KB\n{conversation_history.evicted_users} users evicted",
+        inline=False
+    )
+    restored = conversation_history.restored
+    if restored is not None:
+        pending = restored.pending()
+        embed.add_field(
+            name="Warm Restart",
+            value=f"{restored.restored} conversations restored, "
+                  + (f"{pending} still in snapshot (indexed in {restored.load_seconds * 1000:.0f}ms)" if pending is not None else "snapshot not indexed yet"),
+            inline=False
+        )
+    prompt_lines = [
+        f"`{mode}`: {stats['calls']} calls, avg {stats['prompt_tokens'] // stats['calls']} prompt tokens "
+        f"({stats['cached_tokens'] // stats['calls']} cached), first token {stats['first_token_seconds'] / stats['calls']:.2f}s, "
+        f"total {stats['seconds'] / stats['calls']:.2f}s"
+        for mode, stats in system_prompt_stats.items() if stats["calls"]
+    ]
+    cache = response_cache
+    embed.add_field(
+        name="Command Response Cache",
+        value=f"{cache.hits} exact + {cache.semantic_hits} similar hits / {cache.misses} misses\n{len(cache)} entries cached",
+        inline=False
+    )
+    prompt_lines.append(
+        f"Single-flight: {single_flight_stats['coalesced']} calls + {single_flight_stats['coalesced_streams']} streams coalesced"
+    )
+    embed.add_field(name="System Prompt Delivery", value="\n".join(prompt_lines), inline=False)
+    model_lines = [
+        f"`{model}`: {t.calls} calls, p50 {t.percentile(0.5):.2f}s / p95 {t.percentile(0.95):.2f}s, "
+        f"{t.prompt_tokens // max(t.calls - t.errors, 1)} in / {t.output_tokens // max(t.calls - t.errors, 1)} out tokens, "
+        f"{t.errors / t.calls:.0%} errors"
+        for model, t in model_telemetry.items() if t.calls
+    ]
+    if model_fallbacks:
+        model_lines.append("Fallbacks: " + ", ".join(f"{task} {count}" for task, count in model_fallbacks.items()))
+    embed.add_field(name="Models", value="\n".join(model_lines) or "No Gemini calls yet", inline=False)
+    embed.add_field(
+        name="Admission Control",
+        value=f"{admission.stats['admitted']} admitted ({admission.stats['queued']} queued), {admission.stats['rejected']} rejected\n"
+              f"{admission.queue_length()} waiting now, {admission.stats['throttled']} Gemini 429 pauses",
+        inline=False
+    )
+    embed.add_field(name="Message Pipeline", value="\n".join(stage_lines) or "No messages yet", inline=False)
+    
+    await ctx.send(embed=embed)
+
 # ============================================================================
 # CREATIVE TOOLS COMMANDS
 # ============================================================================
@@ -2892,7 +5303,7 @@ async def creative_command(ctx, *, topic: str = None):
     
     try:
         prompt = f"Generate 5 creative and unique ideas, prompts, or concepts for: {topic}. Be imaginative and innovative."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         await ctx.send(f"💡 **Creative Ideas for '{topic}'**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2906,8 +5317,7 @@ async def story_command(ctx, *, prompt: str = None):
     
     try:
         gemini_prompt = f"Write a creative short story (3-4 paragraphs) based on: {prompt}"
-        response = get_gemini_response(gemini_prompt, ctx.author.id, username=ctx.author.name)
-        await ctx.send(f"📖 **Story**: {response[:1900]}")
+        await send_streamed_response(ctx.send, stream_gemini_response(gemini_prompt, ctx.author.id, username=ctx.author.name, task=TASK_LONG_FORM), prefix="📖 **Story**: ")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
 
@@ -2920,7 +5330,7 @@ async def quote_command(ctx, style: str = None):
     
     try:
         prompt = f"Generate an original {style} quote that is meaningful and memorable."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "quote", style, prompt)
         await ctx.send(f"✨ **Quote**: {response[:500]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2934,7 +5344,7 @@ async def brainstorm_command(ctx, *, topic: str = None):
     
     try:
         prompt = f"Brainstorm 8 creative and practical ideas for: {topic}. List them clearly with brief explanations."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         await ctx.send(f"🧠 **Brainstorm Results**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2948,7 +5358,7 @@ async def design_command(ctx, *, project: str = None):
     
     try:
         prompt = f"Suggest 5 design themes, color schemes, and layout ideas for: {project}. Be specific and modern."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
         await ctx.send(f"🎨 **Design Suggestions**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2962,7 +5372,7 @@ async def name_command(ctx, category: str = None):
     
     try:
         prompt = f"Generate 10 creative, catchy, and memorable {category} names. They should be unique and cool."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "name", category, prompt)
         await ctx.send(f"✍️ **Name Ideas**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2976,7 +5386,7 @@ async def aesthetic_command(ctx, style: str = None):
     
     try:
         prompt = f"Suggest a complete {style} aesthetic with: color palette (hex codes), typography, mood, and design elements."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "aesthetic", style, prompt)
         await ctx.send(f"🎭 **{style.title()} Aesthetic**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -2990,7 +5400,7 @@ async def topics_command(ctx, context: str = None):
     
     try:
         prompt = f"Generate 10 interesting and engaging topics for: {context}. Make them relevant and trending."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "topics", context, prompt)
         await ctx.send(f"📋 **Topic Ideas**:\n{response[:1900]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
@@ -3000,11 +5410,55 @@ async def motivate_command(ctx):
     """Send motivational messages"""
     try:
         prompt = "Generate a short, powerful motivational message that will inspire someone to take action today."
-        response = get_gemini_response(prompt, ctx.author.id, username=ctx.author.name)
+        response = await get_command_response(ctx, "motivate", "", prompt)
         await ctx.send(f"💪 **Motivation**: {response[:500]}")
     except Exception as e:
         await ctx.send(f"❌ Error: {str(e)}")
 
+def format_task_counts(counts):
+    if not counts:
+        return "none"
+    return f"{sum(counts.values())} (" + ", ".join(f"{kind} {count}" for kind, count in counts.most_common()) + ")"
+
+async def shutdown_bot(reason):
+    """Shut down once, however many signals or exits ask for it."""
+    if lifecycle.shutdown_task is None:
+        lifecycle.shutdown_task = asyncio.create_task(run_shutdown(reason))
+    await asyncio.shield(lifecycle.shutdown_task)
+
+async def run_shutdown(reason):
+    started = time.monotonic()
+    logger.info(f"Shutting down ({reason}): draining in-flight work for up to {SHUTDOWN_DRAIN_SECONDS:.0f}s")
+    # Stop intake: handlers ignore new events, no more reminders fire, periodic saves finish their
+    # current run and stop (the final saves below cover them)
+    scheduler.stop()
+    for loop in (save_moderation_cache, save_scheduled_jobs, save_state_snapshot):
+        loop.stop()
+    # Drain while still connected, so replies, moderation actions and activity logs can reach Discord
+    drained, abandoned = await lifecycle.drain(SHUTDOWN_DRAIN_SECONDS)
+    pending_writes = state_store.writes.qsize()
+    summary = (f"Drained: {format_task_counts(drained)}\nAbandoned: {format_task_counts(abandoned)}\n"
+               f"Drain took {time.monotonic() - started:.1f}s, {pending_writes} state writes queued")
+    logger.info(f"Shutdown report ({reason}) - " + summary.replace("\n", "; "))
+    if not bot.is_closed():
+        try:
+            await asyncio.wait_for(log_activity("🔌 Bot Shutting Down", f"Reason: {reason}\n{summary}", color=0x95A5A6), 5)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out sending the shutdown activity log")
+    await bot.close()
+    # Flush storage; each step is independent, so one failure doesn't skip the rest
+    for name, step in (("snapshot", save_snapshot()), ("scheduled jobs", save_scheduler()),
+                       ("state store", asyncio.to_thread(state_store.close)), ("http session", close_http_session())):
+        try:
+            await step
+        except Exception as e:
+            logger.error(f"Shutdown: failed to flush {name}: {e}")
+    if MODERATION_CACHE_FILE and moderation_cache.dirty:
+        moderation_cache.save(MODERATION_CACHE_FILE)
+    logger.info(f"Shutdown complete in {time.monotonic() - started:.1f}s")
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
 def run_bot():
     """Function to start the bot with the token from environment variables."""
     # Load configuration
@@ -3017,9 +5471,27 @@ def run_bot():
         logger.error("No Discord token found. Please set the DISCORD_TOKEN environment variable.")
         return
 
+    async def runner():
+        open_state_store()
+        async with bot:
+            # Railway stops containers with SIGTERM; drain and flush instead of dying mid-write
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown_bot(sig.name)))
+                except (NotImplementedError, RuntimeError):
+                    pass  # no signal handlers on Windows event loops
+            try:
+                await bot.start(token)
+            finally:
+                await shutdown_bot("bot stopped")
+
     # Run the bot
     logger.info("Starting bot...")
-    bot.run(os.getenv("DISCORD_TOKEN"))
+    try:
+        asyncio.run(runner())
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     run_bot()
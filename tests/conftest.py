@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# bot.py builds its Gemini client and reads its state files at import; point it at a throwaway
+# directory with a dummy key so the tests never touch real credentials or the working tree
+_state_dir = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("GEMINI_KEY", "test-key")
+for name, filename in (("STATE_DB_FILE", "bot_state.db"), ("SCHEDULER_FILE", "scheduled_jobs.json"),
+                       ("SNAPSHOT_FILE", "state_snapshot.bin")):
+    os.environ.setdefault(name, os.path.join(_state_dir, filename))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,84 @@
+"""Moderation detectors as they were before they were optimized, kept verbatim as the reference
+that the current implementations in bot.py must agree with (tests) and beat (benchmarks/)."""
+import re
+
+from bot import PROFANITY_WORDS, SLUR_PATTERNS
+
+
+def detect_profanity(content):
+    """Detect profanity in message content with fuzzy matching for variations."""
+    content_lower = content.lower()
+    content_normalized = re.sub(r'[^a-z0-9\s]', '', content_lower)
+    content_no_spaces = content_normalized.replace(' ', '')
+    
+    words = re.findall(r'\b\w+\b', content_lower)
+    for word in words:
+        if word in PROFANITY_WORDS:
+            return True, word
+    
+    for phrase in PROFANITY_WORDS:
+        if ' ' in phrase and phrase in content_lower:
+            return True, phrase
+    
+    for pattern in SLUR_PATTERNS:
+        if re.search(pattern, content_no_spaces, re.IGNORECASE):
+            match = re.search(pattern, content_no_spaces, re.IGNORECASE)
+            return True, match.group() if match else "slur variation"
+    
+    return False, None
+
+
+def detect_spam(message_content):
+    """Detect if message is spam."""
+    msg_lower = message_content.lower().strip()
+    
+    # Ignore short messages or empty
+    if len(msg_lower) < 3:
+        return False, None
+    
+    # 1. Repeated same character (e.g., "aaaaaaa")
+    if len(msg_lower) > 5 and len(set(msg_lower.replace(' ', ''))) == 1:
+        return True, "Repeated characters spam"
+    
+    # 2. Mostly one character (>50% same character) - catches "asssadadadasssdadada"
+    char_freq = {}
+    for char in msg_lower:
+        if char != ' ':
+            char_freq[char] = char_freq.get(char, 0) + 1
+    
+    if char_freq:
+        max_char_count = max(char_freq.values())
+        total_chars = sum(char_freq.values())
+        if max_char_count / total_chars > 0.5:  # >50% is one character = spam
+            return True, "Excessive repeated character spam"
+    
+    # 3. Gibberish detection - checking for repeated pattern spam (like "asdasdasd")
+    if len(msg_lower) > 5:
+        # Check for repeated 2-3 char patterns (like "asdasdasd" or "asdaasdaasd")
+        for pattern_len in [2, 3]:
+            if len(msg_lower) >= pattern_len * 3:
+                pattern = msg_lower[:pattern_len]
+                # Count how many times the pattern repeats
+                repeats = 0
+                for i in range(0, len(msg_lower) - pattern_len + 1, pattern_len):
+                    if msg_lower[i:i+pattern_len] == pattern or all(c in pattern for c in msg_lower[i:i+pattern_len]):
+                        repeats += 1
+                
+                # If pattern repeats >60% of the message = spam
+                if repeats >= len(msg_lower) // pattern_len * 0.6:
+                    return True, "Gibberish spam"
+    
+    # 4. Excessive caps (>70% caps in long message)
+    if len(msg_lower) > 10 and message_content.count(message_content.upper()) / len(message_content) > 0.7:
+        return True, "Excessive caps spam"
+    
+    # 5. Excessive mentions (>3 mentions)
+    if message_content.count('@') > 3:
+        return True, "Excessive mentions spam"
+    
+    # 6. Excessive emojis (>5 emojis in short message)
+    emoji_count = len([c for c in message_content if ord(c) > 0x1F300])
+    if emoji_count > 5 and len(msg_lower) < 20:
+        return True, "Excessive emojis spam"
+    
+    return False, None
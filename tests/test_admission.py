@@ -0,0 +1,68 @@
+import asyncio
+
+import bot
+
+
+def test_user_waiting_on_own_bucket_does_not_queue_others():
+    async def scenario():
+        admission = bot.AdmissionController()
+        notices = []
+
+        async def on_queued(position):
+            notices.append(position)
+
+        admission.buckets_for("u1", None)[0].tokens = 0.0
+        throttled = asyncio.create_task(admission.acquire("u1", None, bot.PRIORITY_CHAT, on_queued=on_queued))
+        await asyncio.sleep(0)
+        assert len(admission.waiters) == 1
+
+        await admission.acquire("u2", None, bot.PRIORITY_CHAT, on_queued=on_queued)
+        throttled.cancel()
+        return admission, notices
+
+    admission, notices = asyncio.run(scenario())
+
+    # u1 is sitting out its own rate limit: no queue message for either user, u2 went straight through
+    assert notices == []
+    assert admission.stats["admitted"] == 1
+
+
+def test_global_bucket_queues_and_reports_position():
+    async def scenario():
+        admission = bot.AdmissionController()
+        admission.global_bucket.tokens = 0.0
+        notices = []
+
+        async def on_queued(position):
+            notices.append(position)
+
+        first = asyncio.create_task(admission.acquire("u1", None, bot.PRIORITY_CHAT, on_queued=on_queued))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(admission.acquire("u2", None, bot.PRIORITY_CHAT, on_queued=on_queued))
+        await asyncio.sleep(0)
+        position = admission.position(admission.waiters[-1])
+        first.cancel()
+        second.cancel()
+        return notices, position
+
+    notices, position = asyncio.run(scenario())
+
+    assert notices == [1, 2]
+    assert position == 2
+
+
+def test_position_skips_waiters_held_by_their_own_bucket():
+    async def scenario():
+        admission = bot.AdmissionController()
+        admission.buckets_for("u1", None)[0].tokens = 0.0
+        held = asyncio.create_task(admission.acquire("u1", None, bot.PRIORITY_CHAT))
+        await asyncio.sleep(0)
+        admission.global_bucket.tokens = 0.0
+        blocked = asyncio.create_task(admission.acquire("u2", None, bot.PRIORITY_CHAT))
+        await asyncio.sleep(0)
+        position = admission.position(admission.waiters[-1])
+        held.cancel()
+        blocked.cancel()
+        return position
+
+    assert asyncio.run(scenario()) == 1
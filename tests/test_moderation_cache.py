@@ -0,0 +1,68 @@
+import io
+import json
+
+from PIL import Image, ImageDraw
+
+import bot
+
+
+def jpeg(image, quality=90):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def detailed_image():
+    image = Image.new("L", (256, 256))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, 256, 16):
+        draw.rectangle([i, (i * 7) % 256, i + 12, (i * 7) % 256 + 40], fill=(i * 37) % 256)
+        draw.line([0, i, 255, 255 - i], fill=255 - i, width=3)
+    return image.convert("RGB")
+
+
+def new_cache():
+    return bot.ModerationVerdictCache(4, 3600, 100)
+
+
+def test_flat_images_do_not_share_verdicts():
+    cache = new_cache()
+    white = jpeg(Image.new("RGB", (128, 128), "white"))
+    black = jpeg(Image.new("RGB", (128, 128), "black"))
+    white_sha, white_hash = bot.compute_moderation_keys(white)
+    black_sha, black_hash = bot.compute_moderation_keys(black)
+    assert white_hash == black_hash  # the reason near matching is unsafe for flat images
+
+    cache.put(white_sha, white_hash, False, None)
+    assert cache.get(black_sha, black_hash) is None
+    assert cache.get(white_sha, white_hash) == (False, None)
+
+
+def test_unsafe_verdicts_need_an_exact_match():
+    cache = new_cache()
+    original = jpeg(detailed_image(), quality=90)
+    reencoded = jpeg(detailed_image(), quality=60)
+    original_sha, original_hash = bot.compute_moderation_keys(original)
+    reencoded_sha, reencoded_hash = bot.compute_moderation_keys(reencoded)
+    assert bot.is_detailed_hash(original_hash)
+    assert original_sha != reencoded_sha
+    assert (original_hash ^ reencoded_hash).bit_count() <= cache.tolerance
+
+    cache.put(original_sha, original_hash, True, "YES - explicit")
+    assert cache.get(reencoded_sha, reencoded_hash) is None
+    assert cache.get(original_sha, original_hash) == (True, "YES - explicit")
+
+    cache.put(original_sha, original_hash, False, None)
+    assert cache.get(reencoded_sha, reencoded_hash) == (False, None)
+
+
+def test_verdict_added_during_save_stays_dirty(tmp_path):
+    cache = new_cache()
+    cache.put("a" * 64, 0x0F0F0F0F0F0F0F0F, False, None)
+    entries = cache.snapshot()
+    cache.put("b" * 64, 0xF0F0F0F0F0F0F0F0, False, None)  # arrives while the write runs
+    cache.write(str(tmp_path / "verdicts.json"), entries)
+
+    assert cache.dirty
+    saved = json.loads((tmp_path / "verdicts.json").read_text())
+    assert [entry[0] for entry in saved["verdicts"]] == ["a" * 64]
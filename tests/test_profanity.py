@@ -0,0 +1,51 @@
+import random
+from pathlib import Path
+
+import pytest
+
+import bot
+import legacy_moderation
+
+CORPUS = Path(__file__).parent / "corpus" / "chat_lines.txt"
+CHAT_LINES = CORPUS.read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.parametrize("line", CHAT_LINES)
+def test_matches_legacy_detector_on_corpus(line):
+    assert bot.detect_profanity(line) == legacy_moderation.detect_profanity(line)
+
+
+def test_matches_legacy_detector_on_random_lines():
+    # Shuffled corpus words plus leetspeak, punctuation and spacing noise
+    rng = random.Random(2024)
+    vocabulary = " ".join(CHAT_LINES).split() + sorted(bot.PROFANITY_WORDS)
+    noise = ["1", "!", "@", "$", "0", "3", "4", "9", " ", ".", "-", "_", "*"]
+    for _ in range(5000):
+        words = rng.choices(vocabulary, k=rng.randint(1, 12))
+        line = " ".join(words)
+        if rng.random() < 0.5:
+            chars = list(line)
+            for _ in range(rng.randint(1, 4)):
+                chars.insert(rng.randint(0, len(chars)), rng.choice(noise))
+            line = "".join(chars)
+        if rng.random() < 0.3:
+            line = line.upper()
+        assert bot.detect_profanity(line) == legacy_moderation.detect_profanity(line), line
+
+
+def test_long_message_matches_legacy_detector():
+    line = " ".join(CHAT_LINES)[:2000]
+    assert bot.detect_profanity(line) == legacy_moderation.detect_profanity(line)
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("classic assessment of the bass class", (False, None)),
+    ("go to hell", (True, "hell")),
+    ("son of a bitch it rendered at 720p again", (True, "bitch")),
+    ("sl00t", (False, None)),
+    ("f4g", (True, "f4g")),
+    ("c0ck", (True, "c0ck")),
+    ("a$$h0le", (False, None)),  # "$" is stripped before the slur patterns run, as it always was
+])
+def test_golden_verdicts(line, expected):
+    assert bot.detect_profanity(line) == expected
@@ -0,0 +1,26 @@
+import bot
+
+
+def test_default_matches_the_old_five_joins_a_minute_rule():
+    tracker = bot.JoinTracker(bot.get_raid_windows(123456))
+
+    assert [tracker.record(t) for t in (0, 10, 20, 30)] == [None] * 4
+    assert tracker.record(40) == (60, 5)
+    assert tracker.record(200) is None  # the earlier joins have expired
+
+
+def test_configured_windows_are_capped_at_an_hour(monkeypatch):
+    monkeypatch.setitem(bot.guild_security_settings, 42, {"raid_windows": [[10, 3], [365 * 86400, 2]]})
+
+    assert bot.get_raid_windows(42) == ((10, 3), (bot.RAID_MAX_WINDOW_SECONDS, 2))
+
+
+def test_one_alert_per_cooldown():
+    tracker = bot.JoinTracker(((60, 2),))
+    alerts = 0
+    for i in range(1000):
+        now = i * 0.01
+        if tracker.record(now) and tracker.should_alert(now):
+            alerts += 1
+
+    assert alerts == 1
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import time
+
+import bot
+
+
+def test_per_user_counts_follow_schedule_and_cancel():
+    scheduler = bot.JobScheduler()
+    future = time.time() + 3600
+    first = scheduler.schedule(bot.JOB_REMIND, 1, 10, "a", future + 5)
+    scheduler.schedule(bot.JOB_REMIND, 1, 10, "b", future)
+    scheduler.schedule(bot.JOB_TIMER, 2, 10, "c", future)
+
+    assert scheduler.count_for(1) == 2 and scheduler.count_for(2) == 1
+    assert [job["text"] for job in scheduler.pending_for(1)] == ["b", "a"]
+
+    assert scheduler.cancel(first["id"], 2) is None  # not their job
+    assert scheduler.cancel(first["id"], 1) is first
+    assert scheduler.count_for(1) == 1 and scheduler.count_for(3) == 0
+
+
+def test_fired_jobs_leave_the_count(monkeypatch):
+    delivered = []
+
+    async def fake_deliver(job):
+        delivered.append(job["id"])
+
+    monkeypatch.setattr(bot, "deliver_job", fake_deliver)
+
+    async def run():
+        scheduler = bot.JobScheduler()
+        job = scheduler.schedule(bot.JOB_REMIND, 1, 10, "now", time.time() - 1)
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        scheduler.stop()
+        return scheduler, job
+
+    scheduler, job = asyncio.run(run())
+
+    assert delivered == [job["id"]]
+    assert scheduler.count_for(1) == 0 and not scheduler.user_jobs
+
+
+def test_loaded_jobs_are_counted(tmp_path):
+    path = tmp_path / "jobs.json"
+    jobs = [{"id": i, "kind": bot.JOB_REMIND, "user_id": 7, "channel_id": 1, "message_id": None,
+             "text": str(i), "due": time.time() + i} for i in range(1, 4)]
+    path.write_text(json.dumps({"version": 1, "next_id": 4, "jobs": jobs}))
+    scheduler = bot.JobScheduler()
+    scheduler.load(str(path))
+
+    assert scheduler.count_for(7) == 3
@@ -0,0 +1,51 @@
+import asyncio
+
+import bot
+
+
+class FakeResponse:
+    text = "Use the Warp Stabilizer effect."
+
+
+def test_same_first_question_from_two_users_shares_one_upstream_call(monkeypatch):
+    calls = []
+
+    async def fake_run_gemini_generate(task, contents, config, system_instruction):
+        calls.append(contents)
+        await asyncio.sleep(0.05)
+        return FakeResponse()
+
+    monkeypatch.setattr(bot, "run_gemini_generate", fake_run_gemini_generate)
+
+    async def ask_both():
+        return await asyncio.gather(
+            bot.get_gemini_response("how do I stabilize shaky footage?", 1001, username="alice"),
+            bot.get_gemini_response("how do I stabilize shaky footage?", 1002, username="bob"),
+        )
+
+    answers = asyncio.run(ask_both())
+
+    assert answers == [FakeResponse.text, FakeResponse.text]
+    assert len(calls) == 1
+    bot.conversation_history.clear(1001)
+    bot.conversation_history.clear(1002)
+
+
+def test_users_with_history_are_not_coalesced():
+    bot.conversation_history.append(2001, bot.ROLE_USER, "I edit in Premiere")
+    bot.conversation_history.append(2001, bot.ROLE_MODEL, "Great choice.")
+    _, alice_context = bot.select_system_prompt("same question", "alice")
+    _, bob_context = bot.select_system_prompt("same question", "bob")
+    with_history = bot.build_text_contents("same question", 2001, alice_context)
+    without_history = bot.build_text_contents("same question", 2002, bob_context)
+
+    assert bot.request_fingerprint(bot.TASK_CHAT, with_history, None, "system") != \
+        bot.request_fingerprint(bot.TASK_CHAT, without_history, None, "system")
+    bot.conversation_history.clear(2001)
+
+
+def test_creator_marker_is_kept_without_history():
+    _, context = bot.select_system_prompt("hello", "bmr_official")
+    contents = bot.build_text_contents("hello", 3001, context)
+
+    assert bot.CREATOR_CONTEXT.strip() in contents[-1].parts[0].text
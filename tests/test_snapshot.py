@@ -0,0 +1,71 @@
+import time
+
+import bot
+
+
+def write_previous_snapshot(path, users):
+    bot.write_snapshot(str(path), users, {})
+    restored = bot.RestoredConversations(bot.SnapshotReader(str(path)))
+    restored.load()
+    return restored
+
+
+def fresh_store(monkeypatch, restored, max_users=100, idle_ttl_seconds=3600):
+    store = bot.ConversationStore(max_users, idle_ttl_seconds, 10000)
+    store.restored = restored
+    monkeypatch.setattr(bot, "conversation_history", store)
+    return store
+
+
+def test_carried_over_users_expire_and_are_capped(tmp_path, monkeypatch):
+    now = time.time()
+    restored = write_previous_snapshot(tmp_path / "old.bin", [
+        (1, now - 60, [(bot.ROLE_USER, "recent")]),
+        (2, now - 7200, [(bot.ROLE_USER, "idle past the TTL")]),
+        (3, now - 120, [(bot.ROLE_USER, "older")]),
+    ])
+    store = fresh_store(monkeypatch, restored, max_users=2)
+    store.append(4, bot.ROLE_USER, "live")
+
+    users, _ = bot.capture_snapshot()
+
+    assert sorted(user_id for user_id, _, _ in users) == [1, 4]
+
+
+def test_carried_over_payloads_round_trip_unchanged(tmp_path, monkeypatch):
+    turns = [(bot.ROLE_USER, "how do I key green screen?"), (bot.ROLE_MODEL, "Use Keylight 1.2.")]
+    restored = write_previous_snapshot(tmp_path / "old.bin", [(7, time.time() - 30, turns)])
+    fresh_store(monkeypatch, restored)
+
+    users, states = bot.capture_snapshot()
+    bot.write_snapshot(str(tmp_path / "new.bin"), users, states)
+    restored = bot.RestoredConversations(bot.SnapshotReader(str(tmp_path / "new.bin")))
+    restored.load()
+    store = fresh_store(monkeypatch, restored)
+
+    assert [(turn.role, turn.text) for turn in store.get(7)] == turns
+
+
+def test_lookup_before_indexing_starts_fresh_without_loading(tmp_path, monkeypatch):
+    bot.write_snapshot(str(tmp_path / "old.bin"), [(9, time.time() - 30, [(bot.ROLE_USER, "old")])], {})
+    restored = bot.RestoredConversations(bot.SnapshotReader(str(tmp_path / "old.bin")))
+    store = fresh_store(monkeypatch, restored)
+
+    assert list(store.get(9)) == []
+    assert restored.index is None  # nothing was loaded on the caller's thread
+
+    restored.load()
+    assert list(store.get(9)) == []
+    assert bot.capture_snapshot()[0] == []
+
+
+def test_clear_before_indexing_is_not_undone(tmp_path, monkeypatch):
+    bot.write_snapshot(str(tmp_path / "old.bin"), [(5, time.time() - 30, [(bot.ROLE_USER, "forget me")])], {})
+    restored = bot.RestoredConversations(bot.SnapshotReader(str(tmp_path / "old.bin")))
+    store = fresh_store(monkeypatch, restored)
+
+    store.clear(5)
+    restored.load()
+
+    assert list(store.get(5)) == []
+    assert bot.capture_snapshot()[0] == []
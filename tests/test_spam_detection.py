@@ -0,0 +1,40 @@
+import random
+from pathlib import Path
+
+import pytest
+
+import bot
+import legacy_moderation
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+LINES = (CORPUS_DIR / "chat_lines.txt").read_text(encoding="utf-8").splitlines() + \
+    (CORPUS_DIR / "spam_lines.txt").read_text(encoding="utf-8").splitlines()
+
+
+@pytest.mark.parametrize("line", LINES)
+def test_matches_legacy_detector_on_corpus(line):
+    assert bot.detect_spam(line) == legacy_moderation.detect_spam(line)
+
+
+def test_matches_legacy_detector_on_random_lines():
+    # Repetitive fragments are where the gibberish and dominant-character rules disagree most easily
+    rng = random.Random(2024)
+    fragments = ["a", "as", "asd", "ab", "x", "lol", "ha", " ", "@", "🔥", "E", "Q", "!", "1"]
+    for _ in range(5000):
+        line = "".join(rng.choices(fragments, k=rng.randint(1, 40)))
+        if rng.random() < 0.3:
+            line = rng.choice(LINES) + line
+        assert bot.detect_spam(line) == legacy_moderation.detect_spam(line), line
+
+
+def test_long_messages_match_legacy_detector():
+    for line in (" ".join(LINES)[:2000], "asd" * 666, "a" * 1999 + "b", "HELLO THERE " * 160):
+        assert bot.detect_spam(line) == legacy_moderation.detect_spam(line)
+
+
+def test_caps_rule_is_opt_in(monkeypatch):
+    line = "WHY IS MY RENDER SO SLOW"
+    assert bot.detect_spam(line) == (False, None)
+
+    monkeypatch.setattr(bot, "SPAM_CAPS_CHECK", True)
+    assert bot.detect_spam(line) == (True, "Excessive caps spam")
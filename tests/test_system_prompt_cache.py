@@ -0,0 +1,41 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+
+    async def create(self, model, config):
+        self.created.append(config.system_instruction)
+        return type("Cache", (), {"name": f"cachedContents/{len(self.created)}"})()
+
+
+def test_only_fixed_prompts_are_cached(monkeypatch):
+    caches = FakeCaches()
+    monkeypatch.setattr(bot, "gemini_client", SimpleNamespace(aio=SimpleNamespace(caches=caches)))
+    cache = bot.SystemPromptCache(3600, 300, 600)
+    cache.register(bot.EDITING_SYSTEM_PROMPT)
+
+    async def lookups():
+        return [
+            await cache.get_name("model", bot.EDITING_SYSTEM_PROMPT),
+            await cache.get_name("model", bot.EDITING_SYSTEM_PROMPT),
+            await cache.get_name("model", bot.get_tutorial_prompt("After Effects")),
+            await cache.get_name("model", bot.get_tutorial_prompt("some user text", brief=True)),
+        ]
+
+    names = asyncio.run(lookups())
+
+    assert names == ["cachedContents/1", "cachedContents/1", None, None]
+    assert caches.created == [bot.EDITING_SYSTEM_PROMPT]
+    assert len(cache.entries) == 1 and not cache.retry_after and len(cache.locks) == 1
+
+
+def test_module_registers_the_fixed_prompts():
+    registered = bot.system_prompt_cache.prompt_keys
+    assert bot.EDITING_SYSTEM_PROMPT in registered
+    assert bot.get_rude_system_prompt() in registered
+    assert bot.get_tutorial_prompt("Photoshop") not in registered
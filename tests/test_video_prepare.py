@@ -0,0 +1,59 @@
+import asyncio
+import io
+import os
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeContent:
+    async def iter_chunked(self, size):
+        yield b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 64
+
+
+class FakeDownload:
+    status = 200
+    content = FakeContent()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def get(self, url, timeout=None):
+        return FakeDownload()
+
+
+class FakeFiles:
+    def __init__(self):
+        self.uploaded = []
+
+    async def upload(self, file, config):
+        # Same contract as the SDK: a path or an io.IOBase, read in blocking mode
+        assert isinstance(file, (str, os.PathLike, io.IOBase)), type(file)
+        self.uploaded.append(file.read() if isinstance(file, io.IOBase) else file)
+        return SimpleNamespace(name="files/1", state=bot.types.FileState.ACTIVE)
+
+
+def test_failed_keyframe_extraction_uploads_the_full_video(monkeypatch):
+    files = FakeFiles()
+
+    async def broken_extract_keyframes(*args):
+        raise RuntimeError("ffmpeg exited with 1")
+
+    monkeypatch.setattr(bot, "get_http_session", lambda: FakeSession())
+    monkeypatch.setattr(bot, "gemini_client", SimpleNamespace(aio=SimpleNamespace(files=files)))
+    monkeypatch.setattr(bot, "extract_keyframes", broken_extract_keyframes)
+    cache = bot.PreparedVideoCache(60, 4, 4)
+
+    prepared, error = asyncio.run(cache.get(
+        "https://cdn.example.com/clip.mp4?ex=1", "clip.mp4", mode=bot.VIDEO_MODE_KEYFRAMES
+    ))
+
+    assert error is None
+    assert prepared.name == "files/1"
+    assert files.uploaded and files.uploaded[0].startswith(b"\x00\x00\x00\x18ftyp")
+    assert cache.prepared[bot.VIDEO_MODE_FULL] == 1